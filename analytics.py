@@ -0,0 +1,127 @@
+# analytics.py
+"""
+Спреды Thermos ↔ TG market на массивах NumPy.
+
+Столбцы снапшота (цена Thermos в TON, цена TG в звёздах, редкость в ‰)
+собираются один раз при пересборке снапшота. Запрос с курсом и комиссиями
+— один векторный проход по всем строкам без циклов Python:
+  spread      — разница цен в TON: продажа − покупка;
+  spread_pct  — та же разница в % от цены покупки;
+  profit      — выручка за вычетом комиссии продажи минус цена с комиссией покупки, TON;
+  profit_pct  — profit в % от затрат;
+  score       — profit_pct с весом редкости: редкие модели выше.
+Отбор — маски порогов, top-K — np.argpartition + сортировка только K строк.
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Комиссии площадок, доли: buy — сверх цены лота, sell — удерживается с продажи.
+# Подправьте под текущие условия; в запросе их можно переопределить.
+FEES = {
+    "thermos": {"buy": 0.0, "sell": 0.05},
+    "tg": {"buy": 0.0, "sell": 0.10},
+}
+# Направления сделки: откуда покупаем → куда продаём
+DIRECTIONS = {
+    "thermos_to_tg": ("thermos", "tg"),
+    "tg_to_thermos": ("tg", "thermos"),
+}
+# Вес редкости: (RARITY_REF / rarity) ** RARITY_EXP, rarity в ‰ (меньше — реже).
+# Модель с RARITY_REF ‰ имеет вес 1; без редкости — тоже 1.
+RARITY_REF = 10.0
+RARITY_EXP = 0.5
+RARITY_MIN = 0.1                    # ‰: ниже — считаем равной, чтобы вес не взлетал
+
+METRICS = ("spread", "spread_pct", "profit", "profit_pct", "score")
+
+
+def _value(v: Any) -> float:
+    return np.nan if v is None else float(v)
+
+
+@dataclass(frozen=True)
+class SpreadTable:
+    """Столбцы снапшота; NaN — цены или редкости нет."""
+    thermos: np.ndarray                 # TON
+    tg: np.ndarray                      # звёзды
+    rarity: np.ndarray                  # ‰
+    weight: np.ndarray                  # вес редкости, от курса не зависит
+
+    def __len__(self) -> int:
+        return len(self.thermos)
+
+
+def build_table(rows: List[Dict[str, Any]]) -> SpreadTable:
+    n = len(rows)
+    thermos = np.fromiter((_value(r.get("thermos_price")) for r in rows), dtype=np.float64, count=n)
+    tg = np.fromiter((_value(r.get("tgmarket_price")) for r in rows), dtype=np.float64, count=n)
+    rarity = np.fromiter((_value(r.get("rarity_per_mille")) for r in rows), dtype=np.float64, count=n)
+    weight = (RARITY_REF / np.maximum(rarity, RARITY_MIN)) ** RARITY_EXP
+    weight[np.isnan(weight)] = 1.0
+    return SpreadTable(thermos=thermos, tg=tg, rarity=rarity, weight=weight)
+
+
+def compute(
+    table: SpreadTable,
+    rate: float,
+    direction: str = "thermos_to_tg",
+    buy_fee: Optional[float] = None,
+    sell_fee: Optional[float] = None,
+) -> Dict[str, np.ndarray]:
+    """Все метрики по всем строкам за один проход; rate — звёзд за 1 TON."""
+    src, dst = DIRECTIONS[direction]
+    buy_fee = FEES[src]["buy"] if buy_fee is None else buy_fee
+    sell_fee = FEES[dst]["sell"] if sell_fee is None else sell_fee
+
+    prices = {"thermos": table.thermos, "tg": table.tg / rate}
+    buy, sell = prices[src], prices[dst]
+    # Нулевая цена покупки — битая строка, а не бесконечная выгода
+    buy = np.where(buy > 0, buy, np.nan)
+
+    cost = buy * (1.0 + buy_fee)
+    profit = sell * (1.0 - sell_fee) - cost
+    profit_pct = profit / cost * 100.0
+    spread = sell - buy
+    return {
+        "spread": spread,
+        "spread_pct": spread / buy * 100.0,
+        "profit": profit,
+        "profit_pct": profit_pct,
+        "score": profit_pct * table.weight,
+    }
+
+
+def select(
+    metrics: Dict[str, np.ndarray],
+    by: str,
+    k: int,
+    thresholds: Optional[Dict[str, float]] = None,
+) -> np.ndarray:
+    """
+    Индексы не более k строк с наибольшим metrics[by] (по убыванию),
+    прошедших все пороги {метрика: минимум}. Строки с NaN не проходят.
+    """
+    values = metrics[by]
+    mask = ~np.isnan(values)
+    for name, lo in (thresholds or {}).items():
+        mask &= metrics[name] >= lo          # NaN >= x → False
+    idx = np.flatnonzero(mask)
+    if k < len(idx):
+        part = np.argpartition(values[idx], len(idx) - k)[len(idx) - k:]
+        idx = idx[part]
+    return idx[np.argsort(-values[idx], kind="stable")]
+
+
+def summarize(table: SpreadTable, metrics: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    """Сколько строк сравнимо и сколько в плюсе после комиссий."""
+    profit = metrics["profit"]
+    comparable = ~np.isnan(profit)
+    best = float(np.nanmax(metrics["profit_pct"])) if comparable.any() else None
+    return {
+        "rows": len(table),
+        "comparable": int(comparable.sum()),
+        "profitable": int((profit > 0).sum()),
+        "best_profit_pct": best if best is not None and np.isfinite(best) else None,
+    }
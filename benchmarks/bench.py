@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# benchmarks/bench.py
+"""
+Офлайн-бенчмарки горячих путей без живого Telegram/Thermos.
+
+  python benchmarks/bench.py scan    — full_scan_floors / min_price_by_hybrid через FakeClient
+  python benchmarks/bench.py thermos — fetch_attributes + parse_and_group против ThermosStub
+  python benchmarks/bench.py panel   — load_data и HTTP-задержка GET / и /api/gifts
+  python benchmarks/bench.py record  — записать фикстуру с живого рынка (нужна сессия)
+
+Размеры каталога: --sizes 20x300,80x2000 (подарков x лотов на подарок)
+или --fixture file.json. Отчёт — таблица в stdout и --json для сравнения прогонов.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "gifts_parcers"), str(Path(__file__).resolve().parent)]
+
+from fake_telegram import FakeClient, Fixture, load_fixture, record_fixture, save_fixture, synthetic_catalog  # noqa: E402
+from thermos_stub import ThermosStub  # noqa: E402
+from gift_rows import GiftRow, dump_row, read_rows  # noqa: E402
+
+
+def fixtures(args) -> List[Tuple[str, Fixture]]:
+    if args.fixture:
+        return [(Path(args.fixture).stem, load_fixture(args.fixture))]
+    out = []
+    for size in args.sizes.split(","):
+        gifts, lots = (int(x) for x in size.lower().split("x"))
+        out.append((size, synthetic_catalog(gifts, lots, seed=args.seed)))
+    return out
+
+
+def true_floors(fixture: Fixture) -> Dict[Tuple[str, str], float]:
+    floors: Dict[Tuple[str, str], float] = {}
+    for rec in fixture.values():
+        for lot in rec["lots"]:
+            key = (rec["title"], lot["model"])
+            floors[key] = min(lot["price"], floors.get(key, lot["price"]))
+    return floors
+
+
+def print_table(rows: List[Dict[str, Any]]) -> None:
+    if not rows:
+        return
+    cols = list(rows[0])
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in cols}
+    print("  ".join(c.ljust(widths[c]) for c in cols))
+    for r in rows:
+        print("  ".join(str(r[c]).ljust(widths[c]) for c in cols))
+
+
+# ─── СКАН TG ─────────────────────────────────────────────────────────────────
+def configure_tg(tg, state_dir: str, *, strategy: str, max_req: int, gifts_conc: int, page_limit: int) -> None:
+    tg.FLOOR_STRATEGY = strategy
+    tg.PAGE_LIMIT = page_limit
+    tg.MAX_CONCURRENT_REQUESTS = max_req
+    tg.LIMITER = tg.AdaptiveLimiter(min(tg.START_CONCURRENT_REQUESTS, max_req), tg.MIN_CONCURRENT_REQUESTS, max_req)
+    tg.GIFT_SEM = asyncio.Semaphore(gifts_conc)
+    tg.VERIFY_SEM = asyncio.Semaphore(tg.VERIFY_CONCURRENCY)
+    tg.CHECKPOINT_FILE = os.path.join(state_dir, "checkpoint.jsonl")
+    tg.CHECKPOINT_TTL = 0
+    tg.GIFT_STATS_FILE = os.path.join(state_dir, "gift_stats.json")
+    tg.MODEL_CATALOG_FILE = os.path.join(state_dir, "model_catalog.json")
+    tg.RUN_METRICS_FILE = os.path.join(state_dir, "run_metrics.json")
+    tg.GIFT_STATS.clear()
+    tg._GIFTS_CATALOG = None
+    tg.VERBOSE = False
+    tg.PROGRESS_HOOK = lambda event: None
+    tg.log = lambda msg: None
+
+
+async def scan_once(tg, fixture: Fixture, out_path: str, args) -> Dict[str, Any]:
+    client = FakeClient(
+        fixture, latency=args.latency, flood_rate=args.flood_rate,
+        flood_seconds=args.flood_seconds, fetch_error_rate=args.fetch_error_rate, seed=args.seed,
+    )
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    rows = await tg.parse_market(client, out_path)
+    wall = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    expected = true_floors(fixture)
+    got = {r.key: r.price for r in read_rows(out_path)}
+    wrong = sum(1 for k, p in expected.items() if got.get(k) != p)
+
+    total_req = sum(client.requests.values())
+    return {
+        "rows": rows,
+        "wall_s": round(wall, 2),
+        "requests": total_req,
+        "req_per_gift": round(total_req / max(1, len(fixture)), 1),
+        "max_req_gift": max(client.requests.values(), default=0),
+        "peak_in_flight": client.peak_in_flight,
+        "floods": client.floods,
+        "fetch_errors": client.fetch_errors,
+        "peak_mem_mb": round(peak / 2**20, 1),
+        "wrong_floors": wrong,
+    }
+
+
+def bench_scan(args) -> List[Dict[str, Any]]:
+    import parce_tg_market_kurigram as tg
+
+    results = []
+    combos = itertools.product(
+        args.strategies.split(","),
+        [int(x) for x in args.max_requests.split(",")],
+        [int(x) for x in args.gifts_concurrency.split(",")],
+        [int(x) for x in args.page_limit.split(",")],
+    )
+    for (name, fixture), (strategy, max_req, gifts_conc, page_limit) in itertools.product(fixtures(args), list(combos)):
+        with tempfile.TemporaryDirectory() as state_dir:
+            warm = strategy.endswith("-warm")
+            configure_tg(tg, state_dir, strategy=strategy.replace("-warm", ""),
+                         max_req=max_req, gifts_conc=gifts_conc, page_limit=page_limit)
+            tg.MODEL_CATALOG = None
+            out_path = os.path.join(state_dir, "out.jsonl")
+            if warm:
+                # первый прогон заполняет каталог моделей, меряем второй
+                asyncio.run(scan_once(tg, fixture, out_path, args))
+                configure_tg(tg, state_dir, strategy=strategy.replace("-warm", ""),
+                             max_req=max_req, gifts_conc=gifts_conc, page_limit=page_limit)
+            res = asyncio.run(scan_once(tg, fixture, out_path, args))
+        results.append({
+            "catalog": name, "strategy": strategy, "max_req": max_req,
+            "gifts_conc": gifts_conc, "page_limit": page_limit, **res,
+        })
+    print_table(results)
+    return results
+
+
+# ─── THERMOS ─────────────────────────────────────────────────────────────────
+def bench_thermos(args) -> List[Dict[str, Any]]:
+    import parce_thermos_gifts as thermos
+
+    thermos.PROGRESS_HOOK = lambda event: None
+    results = []
+    for name, fixture in fixtures(args):
+        titles = [rec["title"] for rec in fixture.values()]
+        with ThermosStub(fixture, latency=args.thermos_latency, error_rate=args.thermos_error_rate,
+                         seed=args.seed) as stub:
+            thermos.API_URL = stub.url
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            payloads = thermos.fetch_attributes(titles)
+            t1 = time.perf_counter()
+            groups = thermos.parse_and_group(payloads)
+            t2 = time.perf_counter()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        results.append({
+            "catalog": name,
+            "collections": len(titles),
+            "http_requests": stub.requests,
+            "fetch_s": round(t1 - t0, 3),
+            "parse_ms": round((t2 - t1) * 1000, 1),
+            "models": sum(len(v) for v in groups.values()),
+            "peak_mem_mb": round(peak / 2**20, 1),
+        })
+    print_table(results)
+    return results
+
+
+# ─── ПАНЕЛЬ ──────────────────────────────────────────────────────────────────
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _latencies(url: str, n: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        with urllib.request.urlopen(url) as resp:
+            resp.read()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 2),
+        "p95_ms": round(samples[max(0, int(len(samples) * 0.95) - 1)], 2),
+    }
+
+
+def _write_snapshot(path: Path, rows: List[GiftRow]) -> None:
+    with open(path, "wb") as f:
+        for r in rows:
+            f.write(dump_row(r) + b"\n")
+
+
+def bench_panel(args) -> List[Dict[str, Any]]:
+    import uvicorn
+    import main
+    from price_history import PriceHistory
+    from shared_state import FileLock, SharedSnapshot
+
+    results = []
+    for name, fixture in fixtures(args):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp_dir = Path(tmp)
+            floors = true_floors(fixture)
+            _write_snapshot(tmp_dir / "tg.json", [
+                GiftRow(g, m, 1.0, p) for (g, m), p in floors.items()
+            ])
+            _write_snapshot(tmp_dir / "thermos.json", [
+                GiftRow(g, m, 1.0, round(p * 0.009, 2)) for (g, m), p in floors.items()
+            ])
+            main.TG_FILE = tmp_dir / "tg.json"
+            main.THERMOS_FILE = tmp_dir / "thermos.json"
+            main.history = PriceHistory(str(tmp_dir / "history.sqlite3"))
+            main.shared_snapshot = SharedSnapshot(tmp_dir / "snapshot.bin")
+            main._build_lock = FileLock(tmp_dir / "snapshot.lock")
+            main._snapshot = None
+
+            t0 = time.perf_counter()
+            snap = main.get_snapshot(force=True)
+            cold = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            main.get_snapshot()
+            warm = time.perf_counter() - t0
+
+            port = _free_port()
+            server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+            thread = threading.Thread(target=server.run, daemon=True)
+            thread.start()
+            while not server.started:
+                time.sleep(0.05)
+            base = f"http://127.0.0.1:{port}"
+            index = _latencies(f"{base}/", args.http_requests)
+            api = _latencies(f"{base}/api/gifts?sort=delta&order=desc&rate=100&limit=100", args.http_requests)
+            server.should_exit = True
+            thread.join()
+
+        results.append({
+            "catalog": name,
+            "rows": len(snap.rows),
+            "load_cold_ms": round(cold * 1000, 1),
+            "load_cached_ms": round(warm * 1000, 3),
+            "index_p50_ms": index["p50_ms"],
+            "index_p95_ms": index["p95_ms"],
+            "api_p50_ms": api["p50_ms"],
+            "api_p95_ms": api["p95_ms"],
+        })
+    print_table(results)
+    return results
+
+
+# ─── ЗАПИСЬ ФИКСТУРЫ ─────────────────────────────────────────────────────────
+def record(args) -> None:
+    import parce_tg_market_kurigram as tg
+
+    async def run():
+        async with tg.Client(tg.SESSION, api_id=tg.API_ID, api_hash=tg.API_HASH) as app:
+            gift_ids = await tg.get_all_gift_ids(app)
+            if args.limit_gifts:
+                gift_ids = gift_ids[:args.limit_gifts]
+            return await record_fixture(app, gift_ids, max_pages=args.max_pages)
+
+    fixture = asyncio.run(run())
+    save_fixture(fixture, args.out)
+    print(f"{len(fixture)} gifts, {sum(len(r['lots']) for r in fixture.values())} lots → {args.out}")
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("suite", choices=["scan", "thermos", "panel", "all", "record"])
+    p.add_argument("--sizes", default="20x300,80x2000")
+    p.add_argument("--fixture")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", help="сохранить результаты в файл")
+    # scan
+    p.add_argument("--strategies", default="strict,hybrid,hybrid-warm")
+    p.add_argument("--max-requests", default="16")
+    p.add_argument("--gifts-concurrency", default="8")
+    p.add_argument("--page-limit", default="100")
+    p.add_argument("--latency", type=float, default=0.05)
+    p.add_argument("--flood-rate", type=float, default=0.0)
+    p.add_argument("--flood-seconds", type=int, default=1)
+    p.add_argument("--fetch-error-rate", type=float, default=0.0)
+    # thermos
+    p.add_argument("--thermos-latency", type=float, default=0.2)
+    p.add_argument("--thermos-error-rate", type=float, default=0.0)
+    # panel
+    p.add_argument("--http-requests", type=int, default=50)
+    # record
+    p.add_argument("--out", default="fixture.json")
+    p.add_argument("--limit-gifts", type=int, default=0)
+    p.add_argument("--max-pages", type=int, default=50)
+    args = p.parse_args()
+
+    if args.suite == "record":
+        record(args)
+        return
+    report: Dict[str, Any] = {}
+    for suite, fn in (("scan", bench_scan), ("thermos", bench_thermos), ("panel", bench_panel)):
+        if args.suite in (suite, "all"):
+            print(f"\n== {suite} ==")
+            report[suite] = fn(args)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# benchmarks/fake_telegram.py
+"""
+Подменный pyrogram Client для офлайн-прогонов сканера.
+
+Отвечает на GetStarGifts / GetResaleStarGifts из фикстуры (записанной с
+живого рынка через record_fixture() или сгенерированной synthetic_catalog())
+с настраиваемой задержкой и вбросом FloodWait / INPUT_FETCH_ERROR.
+
+Фикстура: { gift_id: {"title": str, "lots": [{"price", "model", "rarity", "doc_id"}]} }
+"""
+import asyncio
+import json
+import random
+import zlib
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from pyrogram.errors import BadRequest, FloodWait
+
+Fixture = Dict[int, Dict[str, Any]]
+
+
+# ─── TL-ОБЪЕКТЫ ──────────────────────────────────────────────────────────────
+# Парсер читает ответы через getattr и ищет "model" в имени класса атрибута,
+# поэтому достаточно простых классов с теми же именами и полями.
+class StarGiftAttributeModel:
+    def __init__(self, name: str, rarity_permille: Optional[int], doc_id: int):
+        self.name = name
+        self.rarity_permille = rarity_permille
+        self.document = SimpleNamespace(id=doc_id)
+
+
+class StarGiftAttributeIdModel:
+    def __init__(self, document_id: int):
+        self.document_id = document_id
+
+
+class StarGiftAttributeCounter:
+    def __init__(self, attribute: Any, count: int):
+        self.attribute = attribute
+        self.count = count
+
+
+class StarGiftUnique:
+    def __init__(self, title: str, num: int, price: float, attributes: list):
+        self.title = title
+        self.num = num
+        self.resell_stars = price
+        self.attributes = attributes
+
+
+class InputFetchError(BadRequest):
+    """Как неизвестная pyrogram ошибка вида [400 INPUT_FETCH_ERROR_4141824]."""
+    ID = "INPUT_FETCH_ERROR"
+    MESSAGE = "{value}"
+
+
+# ─── ФИКСТУРЫ ────────────────────────────────────────────────────────────────
+def synthetic_catalog(gifts: int, lots_per_gift: int, models_per_gift: int = 40, seed: int = 1) -> Fixture:
+    """Рынок заданного размера; цены моделей — лог-нормальные вокруг своего «флора»."""
+    rnd = random.Random(seed)
+    fixture: Fixture = {}
+    for g in range(gifts):
+        gift_id = 5_000_000_000_000_000_000 + g
+        models = [
+            (f"Model {m}", rnd.choice([5, 10, 15, 20, 25, 30]), gift_id * 1000 + m, rnd.uniform(200, 5000))
+            for m in range(models_per_gift)
+        ]
+        weights = [1.0 / (r / 5) for _, r, _, _ in models]
+        lots = []
+        for _ in range(lots_per_gift):
+            name, rarity, doc_id, base = rnd.choices(models, weights)[0]
+            lots.append({
+                "price": float(round(base * rnd.lognormvariate(0.3, 0.4))),
+                "model": name,
+                "rarity": rarity,
+                "doc_id": doc_id,
+            })
+        fixture[gift_id] = {"title": f"Gift {g}", "lots": lots}
+    return fixture
+
+
+def save_fixture(fixture: Fixture, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({str(k): v for k, v in fixture.items()}, f, ensure_ascii=False)
+
+
+def load_fixture(path: str) -> Fixture:
+    with open(path, "r", encoding="utf-8") as f:
+        return {int(k): v for k, v in json.load(f).items()}
+
+
+async def record_fixture(app, gift_ids: List[int], max_pages: int = 50) -> Fixture:
+    """Снимает книги с живого рынка (по цене, до max_pages страниц на подарок)."""
+    import parce_tg_market_kurigram as tg
+
+    fixture: Fixture = {}
+    for gift_id in gift_ids:
+        title, lots, offset = None, [], ""
+        for _ in range(max_pages):
+            resp = await tg.page_resale(app, gift_id, by_price=True, offset=offset, limit=tg.PAGE_LIMIT)
+            for g in getattr(resp, "gifts", []) or []:
+                title = title or getattr(g, "title", None)
+                name, rarity, doc_id = tg.pick_model_attr(getattr(g, "attributes", None))
+                price = tg.extract_price(g)
+                if name and price is not None:
+                    lots.append({"price": price, "model": name, "rarity": rarity, "doc_id": doc_id})
+            offset = getattr(resp, "next_offset", "")
+            if not offset:
+                break
+        if title:
+            fixture[gift_id] = {"title": title, "lots": lots}
+    return fixture
+
+
+# ─── КЛИЕНТ ──────────────────────────────────────────────────────────────────
+class FakeClient:
+    """
+    latency          — задержка ответа, сек (равномерно в [0.5x, 1.5x]);
+    flood_rate       — доля запросов, отвечающих FloodWait(flood_seconds);
+    fetch_error_rate — доля запросов, отвечающих 400 INPUT_FETCH_ERROR.
+    """
+
+    def __init__(
+        self,
+        fixture: Fixture,
+        *,
+        latency: float = 0.05,
+        flood_rate: float = 0.0,
+        flood_seconds: int = 1,
+        fetch_error_rate: float = 0.0,
+        seed: int = 1,
+    ):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.fetch_error_rate = fetch_error_rate
+        self.rnd = random.Random(seed)
+        self.requests: Counter = Counter()      # gift_id → число запросов
+        self.floods = 0
+        self.fetch_errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.is_connected = True
+        self._books = {}
+        for gift_id, rec in fixture.items():
+            by_price = sorted(rec["lots"], key=lambda lot: lot["price"])
+            by_num = list(rec["lots"])
+            attrs = {
+                lot["doc_id"]: StarGiftAttributeModel(lot["model"], lot["rarity"], lot["doc_id"])
+                for lot in rec["lots"]
+            }
+            attrs_hash = zlib.crc32(",".join(str(d) for d in sorted(attrs)).encode())
+            self._books[gift_id] = SimpleNamespace(
+                title=rec["title"], by_price=by_price, by_num=by_num, attrs=attrs, attrs_hash=attrs_hash,
+            )
+
+    async def invoke(self, req):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency * self.rnd.uniform(0.5, 1.5))
+            name = req.__class__.__name__
+            if name == "GetStarGifts":
+                return SimpleNamespace(hash=1, gifts=[SimpleNamespace(id=gid) for gid in self._books])
+            if name != "GetResaleStarGifts":
+                raise NotImplementedError(name)
+            self.requests[req.gift_id] += 1
+            roll = self.rnd.random()
+            if roll < self.flood_rate:
+                self.floods += 1
+                raise FloodWait(value=self.flood_seconds)
+            if roll < self.flood_rate + self.fetch_error_rate:
+                self.fetch_errors += 1
+                raise InputFetchError(value=f"[400 INPUT_FETCH_ERROR_{self.rnd.randrange(10**6, 10**7)}]")
+            return self._resale(req)
+        finally:
+            self.in_flight -= 1
+
+    def _resale(self, req):
+        book = self._books[req.gift_id]
+        lots = book.by_price if req.sort_by_price else book.by_num
+        if req.attributes:
+            wanted = {a.document_id for a in req.attributes}
+            lots = [lot for lot in lots if lot["doc_id"] in wanted]
+        start = int(req.offset or 0)
+        page = lots[start:start + req.limit]
+        end = start + len(page)
+
+        resp = SimpleNamespace(
+            count=len(lots),
+            gifts=[
+                StarGiftUnique(book.title, start + i, lot["price"], [book.attrs[lot["doc_id"]]])
+                for i, lot in enumerate(page)
+            ],
+            next_offset=str(end) if end < len(lots) else "",
+            attributes=None,
+            attributes_hash=None,
+            counters=None,
+        )
+        if req.attributes_hash is not None:
+            per_model = Counter(lot["doc_id"] for lot in book.by_price)
+            resp.counters = [
+                StarGiftAttributeCounter(StarGiftAttributeIdModel(doc_id), n) for doc_id, n in per_model.items()
+            ]
+            if req.attributes_hash != book.attrs_hash:
+                resp.attributes = list(book.attrs.values())
+                resp.attributes_hash = book.attrs_hash
+        return resp
@@ -0,0 +1,83 @@
+# benchmarks/thermos_stub.py
+"""
+Локальная замена proxy.thermos.gifts для офлайн-прогонов.
+
+POST /api/v1/attributes {"collections": [...]} → ответ в формате Thermos
+по фикстуре (та же, что у fake_telegram) с задержкой и долей 503.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+from fake_telegram import Fixture
+
+
+def thermos_payload(fixture: Fixture, discount: float = 0.9) -> Dict[str, Any]:
+    """{ title: {"models": [{name, rarity_per_mille, stats: {floor}}]} }; floor в нано-TON."""
+    payload: Dict[str, Any] = {}
+    for rec in fixture.values():
+        floors: Dict[str, Any] = {}
+        for lot in rec["lots"]:
+            cur = floors.get(lot["model"])
+            if cur is None or lot["price"] < cur[0]:
+                floors[lot["model"]] = (lot["price"], lot["rarity"])
+        payload[rec["title"]] = {
+            "models": [
+                {"name": name, "rarity_per_mille": rarity, "stats": {"floor": int(price * discount / 100 * 1e9)}}
+                for name, (price, rarity) in floors.items()
+            ]
+        }
+    return payload
+
+
+class ThermosStub:
+    def __init__(self, fixture: Fixture, *, latency: float = 0.2, error_rate: float = 0.0, seed: int = 1):
+        self.payload = thermos_payload(fixture)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rnd = random.Random(seed)
+        self.requests = 0
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/api/v1/attributes"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                stub.requests += 1
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                time.sleep(stub.latency)
+                if stub.rnd.random() < stub.error_rate:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                wanted = body.get("collections") or []
+                data = json.dumps({c: stub.payload[c] for c in wanted if c in stub.payload}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self) -> "ThermosStub":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,134 @@
+# gifts_parcers/gift_rows.py
+"""
+Строка снапшота парсеров: подарок, модель, редкость, флор.
+
+GiftRow — __slots__ без __dict__, редкость — число в ‰ (2.5); запятая
+появляется только при показе в панели. Файл снапшота — JSONL, каждая
+строка — компактный массив [gift, model, rarity, price] (через orjson,
+если он установлен). Читаются и прежние снапшоты: JSON-массив объектов
+с indent=2 и JSONL-объекты с rarity_per_mille строкой "2,5".
+"""
+import json
+from typing import Any, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class GiftRow:
+    __slots__ = ("gift", "model", "rarity", "price")
+
+    def __init__(self, gift: str, model: str, rarity: Optional[float], price: Optional[float]):
+        self.gift = gift
+        self.model = model
+        self.rarity = rarity
+        self.price = price
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.gift, self.model
+
+    def to_list(self) -> List[Any]:
+        return [self.gift, self.model, self.rarity, self.price]
+
+    @classmethod
+    def from_obj(cls, obj: Any) -> "GiftRow":
+        """Строка нового формата (массив) или прежнего (объект)."""
+        if isinstance(obj, list):
+            gift, model, rarity, price = obj
+            return cls(gift, model, rarity, price)
+        return cls(
+            obj["gift"], obj["model"], parse_rarity(obj.get("rarity_per_mille")),
+            _float(obj.get("price")),
+        )
+
+    def __repr__(self) -> str:
+        return f"GiftRow({self.gift!r}, {self.model!r}, {self.rarity!r}, {self.price!r})"
+
+
+def _float(v: Any) -> Optional[float]:
+    return None if v is None else float(v)
+
+
+def parse_rarity(v: Any) -> Optional[float]:
+    """2.5 | "2,5" | "2.5" → 2.5; непонятное → None."""
+    if v is None or isinstance(v, float):
+        return v
+    if isinstance(v, int):
+        return float(v)
+    try:
+        return float(str(v).replace(",", "."))
+    except ValueError:
+        return None
+
+
+# ─── СЕРИАЛИЗАЦИЯ ────────────────────────────────────────────────────────────
+if orjson is not None:
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    loads = orjson.loads
+else:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    loads = json.loads
+
+
+def dump_row(row: GiftRow) -> bytes:
+    """Одна строка JSONL без перевода строки."""
+    return dumps(row.to_list())
+
+
+def _is_row_line(line: bytes) -> bool:
+    # Новая строка — массив из 4 значений; прежний файл-массив начинается с "[" и переноса
+    try:
+        obj = loads(line)
+    except ValueError:
+        return False
+    return isinstance(obj, list) and len(obj) == 4 and isinstance(obj[0], str)
+
+
+def read_lines(path: str) -> Iterator[Tuple[GiftRow, bytes]]:
+    """
+    (строка, её байты в новом формате) по одной. Строки нового формата
+    отдаются как есть — их можно переписать в другой файл без пересериализации.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        first = f.readline()
+        while first and not first.strip():
+            first = f.readline()
+        if first.lstrip().startswith(b"[") and not _is_row_line(first):
+            for obj in loads(first + f.read()):
+                row = GiftRow.from_obj(obj)
+                yield row, dump_row(row)
+            return
+        for line in _chain(first, f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = loads(line)
+            except ValueError:
+                continue        # недописанная строка
+            if isinstance(obj, list):
+                yield GiftRow.from_obj(obj), line
+            else:
+                row = GiftRow.from_obj(obj)
+                yield row, dump_row(row)
+
+
+def _chain(first: bytes, rest) -> Iterator[bytes]:
+    yield first
+    yield from rest
+
+
+def read_rows(path: str) -> Iterator[GiftRow]:
+    for row, _ in read_lines(path):
+        yield row
@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 import asyncio
+import contextvars
+import heapq
+import itertools
 import json
-import random
-from typing import Any, Dict, List, Optional, Tuple
+import multiprocessing as mp
+import os
+import argparse
+import queue
+import re
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from time import perf_counter
 from pyrogram import Client, raw
 from datetime import datetime
@@ -13,34 +22,97 @@ try:
 except Exception:
     from pyrogram.errors import FloodWait, RPCError
 
+from parser_metrics import REGISTRY, write_summary
+from gift_rows import GiftRow, dump_row, dumps, loads, read_lines
+
 API_ID = 21757287
 API_HASH = "78389065683ede6c2d7e2b308a634f88"
 BASE_DIR = Path(__file__).resolve().parent
 
-EXE_DIR = Path(sys.argv[0]).resolve().parent
+# Рядом с exe (PyInstaller) или со скриптом — и когда модуль импортирует панель
+EXE_DIR = Path(sys.executable).resolve().parent if getattr(sys, "frozen", False) else BASE_DIR
 SESSION = str(EXE_DIR / "kurigram_resale")
+# Несколько аккаунтов: kurigram_resale.session, kurigram_resale_2.session, ...
+# Каждая сессия сканирует свою долю подарков в отдельном процессе.
+SESSION_GLOB = "kurigram_resale*.session"
 
+# Результат пишется потоково, по строке JSON на запись (JSONL), во временный
+# файл рядом с OUT_FILE; по завершении — fsync и атомарный rename.
 OUT_FILE = "tg_gifts_resale.json"
-PRETTY_JSON = True                  # True → indent=2
-JSONL = False                       # True → по одному объекту на строку
+
+# Чекпоинт: результат каждого подарка дописывается сюда сразу после обработки,
+# перезапуск прерванного обхода пропускает подарки, готовые не раньше
+# CHECKPOINT_TTL секунд назад. Успешный обход публикует файл и удаляет чекпоинт.
+CHECKPOINT_FILE = str(EXE_DIR / "tg_scan_checkpoint.jsonl")
+CHECKPOINT_TTL = 30 * 60            # 0 → не использовать старые результаты
+# fsync чекпоинта не чаще раза в N сек: упавший процесс записанное не теряет
+# (оно уже в кэше ОС), при сбое питания пропадут лишь последние подарки
+CHECKPOINT_SYNC_EVERY = 5.0
+
+# Статистика прошлых прогонов по подаркам (страницы, лоты, время) — для шардинга
+GIFT_STATS_FILE = str(EXE_DIR / "tg_gift_stats.json")
+
+# Сводка последнего прогона: запросы по методам, FloodWait, ошибки, самые долгие подарки
+RUN_METRICS_FILE = str(EXE_DIR / "tg_run_metrics.json")
+SLOWEST_GIFTS_IN_SUMMARY = 15
 
 FLOOR_STRATEGY = "strict"           # "strict" (гарант) или "hybrid" (быстрее)
+FLOOR_EARLY_EXIT = True             # strict: стоп, как только увидели все модели из counters
 
 # Параллелизм и троттлинг
-MAX_CONCURRENT_REQUESTS = 16
+MAX_CONCURRENT_REQUESTS = 16       # потолок для адаптивного лимитера
+MIN_CONCURRENT_REQUESTS = 1
+START_CONCURRENT_REQUESTS = 8
+LIMIT_DECREASE = 0.5                # множитель параллелизма при ошибке
+LIMIT_DECREASE_COOLDOWN = 1.0       # не режем чаще раза в N сек (одна «волна» ошибок)
+LIMIT_LOG_EVERY = 15.0              # сек между строками состояния лимитера
 GIFTS_CONCURRENCY = 8
 VERIFY_CONCURRENCY = 16
-JITTER = (0.02, 0.06)
+
+# Ошибки: flood (FloodWait) — пауза клиента и повтор на месте; transient
+# (INPUT_FETCH_ERROR, 5xx, обрыв связи) — короткий повтор на месте, потом
+# подарок уходит в отложенную очередь в конец прогона и освобождает слот
+# GIFT_SEM; permanent (прочие 4xx) — без повторов, подарок пропускается.
+TRANSIENT_ERRORS = ("INPUT_FETCH_ERROR", "TIMEOUT", "RPC_CALL_FAIL", "RPC_MCGET_FAIL")
+TRANSIENT_RETRIES = 1               # повторов transient на месте
+TRANSIENT_RETRIES_LAST = 6          # ... в последнем проходе отложенной очереди
+DEFERRED_ROUNDS = 2                 # проходов по отложенной очереди
+DEFERRED_DELAY = 10.0               # сек перед каждым проходом
+
+# Предохранитель: если в окне BREAKER_WINDOW сек не меньше BREAKER_MIN_CALLS
+# ответов и доля ошибок ≥ BREAKER_ERROR_RATE — новые запросы ждут BREAKER_PAUSE
+BREAKER_WINDOW = 10.0
+BREAKER_MIN_CALLS = 20
+BREAKER_ERROR_RATE = 0.5
+BREAKER_PAUSE = 15.0
 
 # Пагинация
 PAGE_LIMIT = 100
 
+# Каталог моделей: gift_id → {model: (doc_id, rarity)}, переживает перезапуски.
+# Полностью перечитывается раз в MODEL_CATALOG_TTL или при смене attributes_hash.
+MODEL_CATALOG_FILE = str(EXE_DIR / "tg_model_catalog.json")
+MODEL_CATALOG_TTL = 7 * 24 * 3600
+
 # Для разведки/гибридного режима
 DISCOVERY_PAGES_NUM = 2             # по номеру (num)
 DISCOVERY_PAGES_PRICE = 2           # по цене
 MODEL_DISCOVERY_CAP = 80
 FALLBACK_SCAN_PAGES_FOR_MODEL = 2   # быстрый догляд по имени модели
 
+# Кэш страниц выдачи на время обработки подарка: одинаковые запросы (разведка,
+# полный проход, догляд по каждой модели) идут в сеть один раз. Хранятся
+# первые PAGE_CACHE_PER_GIFT разных страниц — глубокие страницы полного
+# прохода повторно не запрашиваются, держать их в памяти незачем.
+PAGE_CACHE_PER_GIFT = 8
+
+# Наблюдение (--watch): клиент остаётся открытым, по кругу проверяются первая
+# страница по цене каждого подарка и флоры отдельных моделей (limit=1 по doc_id),
+# не больше WATCH_RPS запросов в секунду. Снапшот правится на месте.
+WATCH_RPS = 2.0
+WATCH_MODEL_SHARE = 0.5             # доля бюджета на запросы по doc_id
+WATCH_FLUSH_EVERY = 60.0            # сек между перезаписями снапшота (--flush-every)
+
 # Логи
 LOG_PROGRESS_EVERY_N_GIFTS = 5
 VERBOSE = True
@@ -54,20 +126,234 @@ def now() -> str:
 def log(msg: str) -> None:
     print(f"[{now()}] {msg}", flush=True)
 
+# Машиночитаемый прогресс для панели: в stdout (main.py читает его у
+# подпроцесса) или в PROGRESS_HOOK, когда парсер запущен внутри панели.
+PROGRESS_PREFIX = "@@progress "
+PROGRESS_HOOK: Optional[Callable[[Dict[str, Any]], None]] = None
+
+def report_progress(**fields: Any) -> None:
+    event = {"source": "tg", **fields}
+    if PROGRESS_HOOK is not None:
+        PROGRESS_HOOK(event)
+        return
+    print(PROGRESS_PREFIX + json.dumps(event, ensure_ascii=False), flush=True)
+
+
+# ─── АДАПТИВНЫЙ ЛИМИТЕР (AIMD) ───────────────────────────────────────────────
+class AdaptiveLimiter:
+    """
+    Общий на весь клиент лимит одновременных запросов.
+      • успех     → limit += 1/limit (≈ +1 за «круг» запросов);
+      • RPCError  → limit *= LIMIT_DECREASE;
+      • FloodWait → тот же спад + пауза ВСЕГО клиента на время ожидания;
+      • доля ошибок в окне выше порога → пауза BREAKER_PAUSE (предохранитель).
+    Освободившийся слот получает ожидающий с наибольшим priority (при равенстве —
+    кто раньше пришёл): запросы больших подарков не стоят в очереди за мелкими.
+    """
+
+    def __init__(self, start: int, lo: int, hi: int):
+        self.limit = float(start)
+        self.lo = lo
+        self.hi = hi
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.ok = 0
+        self.errors = 0
+        self.floods = 0
+        self.trips = 0
+        self._window: deque = deque()   # (время ответа, ошибка?)
+        self._waiting: List[Tuple[float, int]] = []     # куча (-priority, номер)
+        self._seq = itertools.count()
+        self._last_decrease = 0.0
+        self._last_log = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, priority: float = 0.0) -> None:
+        ticket = (-priority, next(self._seq))
+        async with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    pause = self.paused_until - time.monotonic()
+                    if pause > 0:
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), pause)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    if self.in_flight < int(self.limit) and self._waiting[0] == ticket:
+                        heapq.heappop(self._waiting)
+                        self.in_flight += 1
+                        # Слот мог остаться и для следующего в очереди
+                        self._cond.notify_all()
+                        return
+                    await self._cond.wait()
+            except BaseException:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+
+    async def release(self, *, error: bool = False, flood_wait: float = 0.0) -> None:
+        async with self._cond:
+            self.in_flight -= 1
+            t = time.monotonic()
+            if flood_wait:
+                self.floods += 1
+                self.paused_until = max(self.paused_until, t + flood_wait)
+            if error or flood_wait:
+                self.errors += int(error)
+                if t - self._last_decrease >= LIMIT_DECREASE_COOLDOWN:
+                    self._last_decrease = t
+                    self.limit = max(float(self.lo), self.limit * LIMIT_DECREASE)
+                    self._log_state("спад")
+            else:
+                self.ok += 1
+                self.limit = min(float(self.hi), self.limit + 1.0 / self.limit)
+            self._check_breaker(t, bool(error or flood_wait))
+            if t - self._last_log >= LIMIT_LOG_EVERY:
+                self._log_state("состояние")
+            self._cond.notify_all()
+
+    def _check_breaker(self, t: float, failed: bool) -> None:
+        self._window.append((t, failed))
+        while self._window and self._window[0][0] < t - BREAKER_WINDOW:
+            self._window.popleft()
+        if len(self._window) < BREAKER_MIN_CALLS:
+            return
+        failures = sum(1 for _, f in self._window if f)
+        if failures / len(self._window) >= BREAKER_ERROR_RATE:
+            self._window.clear()
+            self.trips += 1
+            BREAKER_TRIPS.inc()
+            self.paused_until = max(self.paused_until, t + BREAKER_PAUSE)
+            self._log_state(f"предохранитель: {failures} ошибок за {BREAKER_WINDOW:.0f}s")
+
+    def _log_state(self, reason: str) -> None:
+        self._last_log = time.monotonic()
+        pause = max(0.0, self.paused_until - self._last_log)
+        log(f"Лимитер ({reason}): limit={self.limit:.1f} | в полёте {self.in_flight} | "
+            f"ok {self.ok} | ошибок {self.errors} | FloodWait {self.floods} | пауза {pause:.0f}s")
+
 
 # ─── СЕМАФОРЫ ────────────────────────────────────────────────────────────────
-REQ_SEM = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+LIMITER = AdaptiveLimiter(START_CONCURRENT_REQUESTS, MIN_CONCURRENT_REQUESTS, MAX_CONCURRENT_REQUESTS)
 GIFT_SEM = asyncio.Semaphore(GIFTS_CONCURRENCY)
 VERIFY_SEM = asyncio.Semaphore(VERIFY_CONCURRENCY)
 
 
+# ─── МЕТРИКИ ─────────────────────────────────────────────────────────────────
+RPC_SECONDS = REGISTRY.histogram("tg_rpc_seconds", "Latency of one MTProto call attempt by TL method")
+RPC_ERRORS = REGISTRY.counter("tg_rpc_errors_total", "RPCError responses by error type")
+RPC_RETRIES = REGISTRY.counter("tg_rpc_retries_total", "Repeated attempts of MTProto calls by TL method")
+FLOOD_WAITS = REGISTRY.counter("tg_flood_waits_total", "FloodWait responses")
+FLOOD_WAIT_SECONDS = REGISTRY.counter("tg_flood_wait_seconds_total", "Seconds the client was paused by FloodWait")
+GIFT_PAGES = REGISTRY.histogram("tg_gift_pages", "Resale requests per gift",
+                                buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+GIFT_SECONDS = REGISTRY.histogram("tg_gift_seconds", "Wall time per gift")
+BREAKER_TRIPS = REGISTRY.counter("tg_breaker_trips_total", "Client pauses by the error-rate circuit breaker")
+GIFTS_DEFERRED = REGISTRY.counter("tg_gifts_deferred_total", "Gifts moved to the deferred retry queue")
+GIFTS_FAILED = REGISTRY.counter("tg_gifts_failed_total", "Gifts left without rows after all retries by error class")
+WATCH_POLLS = REGISTRY.counter("tg_watch_polls_total", "Watch mode polls by kind (page, model)")
+WATCH_CHANGES = REGISTRY.counter("tg_watch_changes_total", "Floor changes found by watch mode by kind (drop, rise, new, gone)")
+PAGE_CACHE_HITS = REGISTRY.counter("tg_page_cache_hits_total", "Resale pages served from the run cache or joined in flight")
+
+def rpc_method(req) -> str:
+    """functions.payments.GetResaleStarGifts → payments.GetResaleStarGifts"""
+    name = getattr(req, "QUALNAME", None) or req.__class__.__name__
+    return name[len("functions."):] if name.startswith("functions.") else name
+
+def rpc_error_type(e: RPCError) -> str:
+    """
+    Тип ошибки без переменной части: неизвестные pyrogram ошибки приходят
+    как "[400 INPUT_FETCH_ERROR_4141824]" → INPUT_FETCH_ERROR.
+    """
+    m = re.match(r"\[\d+ ([A-Z_]*[A-Z])", str(getattr(e, "value", "") or ""))
+    if m:
+        return m.group(1)
+    return getattr(e, "ID", None) or e.__class__.__name__
+
+def classify_error(e: BaseException) -> str:
+    """-> "flood" | "transient" | "permanent" (см. TRANSIENT_ERRORS)."""
+    if isinstance(e, FloodWait):
+        return "flood"
+    if isinstance(e, RPCError):
+        code = getattr(e, "CODE", None)
+        if rpc_error_type(e) in TRANSIENT_ERRORS or (isinstance(code, int) and code >= 500):
+            return "transient"
+        return "permanent"
+    if isinstance(e, (OSError, TimeoutError, ConnectionError)):
+        return "transient"
+    return "permanent"
+
+
+# ─── СТАТИСТИКА ПО ПОДАРКАМ ───────────────────────────────────────────────────
+# gift_id → {"pages", "listings", "seconds", "errors", "floods", "flood_seconds", "cache_hits"} текущего прогона
+GIFT_STATS: Dict[int, Dict[str, Any]] = {}
+
+# gift_id → ожидаемая длительность, сек (см. gift_costs): приоритет в LIMITER
+GIFT_PRIORITY: Dict[int, float] = {}
+
+def count_request(gift_id: int, resp) -> None:
+    st = GIFT_STATS.setdefault(gift_id, {"pages": 0})
+    st["pages"] += 1
+    listings = getattr(resp, "count", None)
+    if listings is not None:
+        st["listings"] = max(int(listings), st.get("listings", 0))
+
+def count_gift(gift_id: Optional[int], field: str, amount: float = 1) -> None:
+    if gift_id is None:
+        return
+    st = GIFT_STATS.setdefault(gift_id, {"pages": 0})
+    st[field] = st.get(field, 0) + amount
+
+def load_gift_stats(path: str) -> Dict[int, Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {int(k): v for k, v in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+def gift_costs(gift_ids: List[int], stats: Dict[int, Dict[str, Any]]) -> Dict[int, float]:
+    """
+    Ожидаемая длительность подарков по прошлым прогонам, сек. Нет seconds —
+    оцениваем по страницам (или лотам) через медианное время страницы;
+    совсем новый подарок — медиана известных.
+    """
+    def median(values: List[float]) -> Optional[float]:
+        return sorted(values)[len(values) // 2] if values else None
+
+    per_page = median([
+        st["seconds"] / st["pages"] for st in stats.values() if st.get("seconds") and st.get("pages")
+    ]) or 0.0
+
+    def estimate(st: Dict[str, Any]) -> Optional[float]:
+        if st.get("seconds"):
+            return float(st["seconds"])
+        pages = st.get("pages") or (st.get("listings") or 0) / PAGE_LIMIT
+        return pages * per_page if pages and per_page else None
+
+    known = {gid: estimate(stats.get(gid) or {}) for gid in gift_ids}
+    default = median([c for c in known.values() if c]) or 1.0
+    return {gid: c or default for gid, c in known.items()}
+
+def save_gift_stats(path: str, stats: Dict[int, Dict[str, Any]]) -> None:
+    merged = load_gift_stats(path)
+    merged.update(stats)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({str(k): v for k, v in merged.items()}, f)
+    os.replace(tmp, path)
+
+
 # ─── ХЕЛПЕРЫ ─────────────────────────────────────────────────────────────────
-def fmt_permille(v: Optional[float | int]) -> Optional[str]:
+def permille(v: Optional[float | int]) -> Optional[float]:
+    """rarity_permille из TL (целое, десятые доли ‰) → ‰ числом."""
     if v is None:
         return None
     if isinstance(v, int):
         v = v / 10.0
-    return f"{float(v):.1f}".replace(".", ",")
+    return round(float(v), 1)
 
 def extract_price(g) -> float | None:
     if g is None:
@@ -93,50 +379,200 @@ def pick_model_attr(attrs: list) -> Tuple[Optional[str], Optional[float | int],
     return None, None, None
 
 
-async def mt_invoke(app: Client, req, *, retries=6):
+# Повторы transient на месте для текущей задачи: последний проход отложенной
+# очереди (scan_gifts) поднимает их до TRANSIENT_RETRIES_LAST
+_TRANSIENT_RETRIES: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("transient_retries", default=None)
+
+async def mt_invoke(app: Client, req, *, retries=6, transient_retries: Optional[int] = None):
+    """
+    retries — повторы после FloodWait; transient_retries — после transient
+    ошибок (дальше их разруливает отложенная очередь scan_gifts).
+    permanent ошибки не повторяются.
+    """
     delay = 1.2
-    for _ in range(retries):
-        async with REQ_SEM:
-            try:
-                resp = await app.invoke(req)
-                await asyncio.sleep(random.uniform(*JITTER))
-                return resp
-            except FloodWait as e:
-                secs = int(getattr(e, "value", 1) or 1)
-                if VERBOSE:
-                    log(f"FloodWait {secs}s → спим")
-                await asyncio.sleep(secs + 1)
-            except RPCError as e:
-                if VERBOSE:
-                    log(f"RPCError: {e.__class__.__name__} → retry через {delay:.1f}s")
-                await asyncio.sleep(delay)
-                delay = min(delay * 2, 10.0)
-    async with REQ_SEM:
-        resp = await app.invoke(req)
-        await asyncio.sleep(random.uniform(*JITTER))
+    transient_left = transient_retries
+    if transient_left is None:
+        transient_left = _TRANSIENT_RETRIES.get()
+    if transient_left is None:
+        transient_left = TRANSIENT_RETRIES
+    method = rpc_method(req)
+    gift_id = getattr(req, "gift_id", None)
+    priority = GIFT_PRIORITY.get(gift_id, 0.0)
+    for attempt in range(retries + 1):
+        if attempt:
+            RPC_RETRIES.inc(method=method)
+        await LIMITER.acquire(priority)
+        t0 = perf_counter()
+        try:
+            resp = await app.invoke(req)
+        except FloodWait as e:
+            RPC_SECONDS.observe(perf_counter() - t0, method=method)
+            secs = int(getattr(e, "value", 1) or 1)
+            FLOOD_WAITS.inc()
+            FLOOD_WAIT_SECONDS.inc(secs + 1)
+            count_gift(gift_id, "floods")
+            count_gift(gift_id, "flood_seconds", secs + 1)
+            await LIMITER.release(flood_wait=secs + 1)
+            if attempt == retries:
+                raise
+            if VERBOSE:
+                log(f"FloodWait {secs}s → пауза всего клиента")
+            continue
+        except RPCError as e:
+            RPC_SECONDS.observe(perf_counter() - t0, method=method)
+            RPC_ERRORS.inc(error=rpc_error_type(e))
+            count_gift(gift_id, "errors")
+            if classify_error(e) == "permanent":
+                # Ответ есть, сервер не перегружен — лимит не трогаем
+                await LIMITER.release()
+                raise
+            await LIMITER.release(error=True)
+            if transient_left <= 0 or attempt == retries:
+                raise
+            transient_left -= 1
+            if VERBOSE:
+                log(f"RPCError: {rpc_error_type(e)} → retry через {delay:.1f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10.0)
+            continue
+        except Exception:
+            await LIMITER.release(error=True)
+            raise
+        except BaseException:
+            await LIMITER.release()
+            raise
+        RPC_SECONDS.observe(perf_counter() - t0, method=method)
+        await LIMITER.release()
         return resp
 
 
 # ─── API ─────────────────────────────────────────────────────────────────────
+# (hash, ids) последнего каталога: при тёплом клиенте сервер ответит
+# StarGiftsNotModified, и список не придётся тянуть заново
+_GIFTS_CATALOG: Optional[Tuple[int, List[int]]] = None
+# gift_id → название из каталога (если сервер его присылает) — для выборочного обхода
+GIFT_TITLES: Dict[int, str] = {}
+
 async def get_all_gift_ids(app: Client) -> List[int]:
-    res = await mt_invoke(app, raw.functions.payments.GetStarGifts(hash=0))
-    ids = [int(g.id) for g in res.gifts]
+    global _GIFTS_CATALOG
+    known_hash = _GIFTS_CATALOG[0] if _GIFTS_CATALOG else 0
+    # Без каталога обходить нечего — здесь повторяем на месте до упора
+    res = await mt_invoke(app, raw.functions.payments.GetStarGifts(hash=known_hash), transient_retries=6)
+    gifts = getattr(res, "gifts", None)
+    if gifts is None and _GIFTS_CATALOG is not None:
+        ids = _GIFTS_CATALOG[1]
+        log(f"Каталог: {len(ids)} подарков (не изменился)")
+        return ids
+    ids = [int(g.id) for g in gifts or []]
+    for g in gifts or []:
+        if getattr(g, "title", None):
+            GIFT_TITLES[int(g.id)] = g.title
+    _GIFTS_CATALOG = (int(getattr(res, "hash", 0) or 0), ids)
     log(f"Каталог: {len(ids)} подарков")
     return ids
 
-async def page_resale(app: Client, gift_id: int, *, by_price: bool, offset: str, limit: int):
-    return await mt_invoke(
-        app,
-        raw.functions.payments.GetResaleStarGifts(
-            sort_by_price=by_price,
-            sort_by_num=not by_price,
-            gift_id=gift_id,
-            offset=offset,
-            limit=limit
+# gift_id → { (by_price, offset, limit): (attributes_hash, Future ответа) }
+PAGE_CACHE: Dict[int, Dict[Tuple[bool, str, int], Tuple[Optional[int], asyncio.Future]]] = {}
+
+async def page_resale(app: Client, gift_id: int, *, by_price: bool, offset: str, limit: int,
+                      attributes_hash: Optional[int] = None):
+    """
+    attributes_hash=0 → сервер вернёт ещё и attributes/counters коллекции.
+
+    Повтор той же страницы берётся из PAGE_CACHE, а если она ещё в полёте —
+    ждёт тот же запрос. Ответ с attributes годится и для запроса без них,
+    наоборот — нет. Кэш подарка живёт до конца process_gift.
+    """
+    key = (by_price, offset, limit)
+    pages = PAGE_CACHE.setdefault(gift_id, {})
+    hit = pages.get(key)
+    if hit is not None and (attributes_hash is None or hit[0] == attributes_hash):
+        PAGE_CACHE_HITS.inc()
+        count_gift(gift_id, "cache_hits")
+        return await asyncio.shield(hit[1])
+
+    fut: Optional[asyncio.Future] = None
+    if hit is not None or len(pages) < PAGE_CACHE_PER_GIFT:
+        fut = asyncio.get_running_loop().create_future()
+        pages[key] = (attributes_hash, fut)
+    try:
+        resp = await mt_invoke(
+            app,
+            raw.functions.payments.GetResaleStarGifts(
+                sort_by_price=by_price,
+                sort_by_num=not by_price,
+                gift_id=gift_id,
+                attributes_hash=attributes_hash,
+                offset=offset,
+                limit=limit
+            )
         )
-    )
+    except BaseException as exc:
+        if fut is not None:
+            # Ошибку получат те, кто уже ждёт; следующий запрос пойдёт заново
+            if pages.get(key, (None, None))[1] is fut:
+                del pages[key]
+            if isinstance(exc, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(exc)
+                fut.exception()     # не логировать «exception was never retrieved»
+        raise
+    if fut is not None:
+        fut.set_result(resp)
+    count_request(gift_id, resp)
+    return resp
+
+def models_from_attributes(resp) -> Optional[Dict[int, Tuple[str, Optional[float | int]]]]:
+    """Все модели коллекции из attributes ответа: { doc_id: (name, rarity) }."""
+    attributes = getattr(resp, "attributes", None)
+    if attributes is None:
+        return None
+    by_doc: Dict[int, Tuple[str, Optional[float | int]]] = {}
+    for a in attributes:
+        if "model" not in a.__class__.__name__.lower():
+            continue
+        doc = getattr(a, "document", None)
+        doc_id = getattr(doc, "id", None) if doc is not None else None
+        name = getattr(a, "name", None)
+        if doc_id is not None and name:
+            rarity = getattr(a, "rarity_permille", None) or getattr(a, "permille", None)
+            by_doc[doc_id] = (name, rarity)
+    return by_doc
+
+def listed_doc_ids(resp) -> Optional[set]:
+    """doc_id моделей, у которых сейчас есть лоты (по counters). None — counters нет."""
+    counters = getattr(resp, "counters", None)
+    if counters is None:
+        return None
+    ids = set()
+    for c in counters:
+        attr = getattr(c, "attribute", None)
+        if "model" in attr.__class__.__name__.lower() and getattr(c, "count", 0):
+            ids.add(getattr(attr, "document_id", None))
+    return ids
+
+def models_from_counters(resp) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Полный набор выставленных моделей по attributes/counters ответа:
+    { model_name: {rarity, doc_id} }. None — если набор нельзя установить точно.
+    """
+    by_doc = models_from_attributes(resp)
+    listed = listed_doc_ids(resp)
+    if by_doc is None or listed is None:
+        return None
 
-async def floor_by_doc_id(app: Client, gift_id: int, doc_id: Optional[int]) -> Optional[float]:
+    models: Dict[str, Dict[str, Any]] = {}
+    for doc_id in listed:
+        if doc_id not in by_doc:
+            return None
+        name, rarity = by_doc[doc_id]
+        models[name] = {"rarity": rarity, "doc_id": doc_id}
+    return models or None
+
+async def floor_by_doc_id(app: Client, gift_id: int, doc_id: Optional[int], *,
+                          raise_permanent: bool = False) -> Optional[float]:
+    """Флор модели; None — лотов нет (или permanent ошибка, если не raise_permanent)."""
     if not doc_id:
         return None
     try:
@@ -151,9 +587,13 @@ async def floor_by_doc_id(app: Client, gift_id: int, doc_id: Optional[int]) -> O
                 limit=1
             )
         )
+        GIFT_STATS.setdefault(gift_id, {"pages": 0})["pages"] += 1
         g = (getattr(resp, "gifts", []) or [None])[0]
         return extract_price(g)
-    except RPCError:
+    except RPCError as e:
+        # Флор модели нельзя молча потерять из-за сбоя: весь подарок — в отложенные
+        if raise_permanent or classify_error(e) != "permanent":
+            raise
         return None
 
 async def min_price_by_scanning(app: Client, gift_id: int, model_name: str, max_pages: int = 2) -> Optional[float]:
@@ -222,7 +662,10 @@ async def discover_models_fast(app: Client, gift_id: int) -> Tuple[Optional[str]
     if not models:
         offset = ""
         for _ in range(DISCOVERY_PAGES_PRICE):
-            resp = await page_resale(app, gift_id, by_price=True, offset=offset, limit=PAGE_LIMIT)
+            # Первая страница — с теми же параметрами, что у full_scan_floors:
+            # полный проход возьмёт её из PAGE_CACHE
+            resp = await page_resale(app, gift_id, by_price=True, offset=offset, limit=PAGE_LIMIT,
+                                     attributes_hash=None if offset else 0)
             gifts = getattr(resp, "gifts", []) or []
             if not gifts:
                 break
@@ -259,7 +702,11 @@ async def full_scan_floors(app: Client, gift_id: int) -> Tuple[Optional[str], Di
     Логика:
       1) короткая разведка discover_models_fast() — узнаём, сколько моделей.
       2) если модель ровно одна → любые лоты (в т.ч. без model-атрибута) считаем этой моделью.
-      3) идём по ВСЕЙ выдаче sort_by_price=True до конца и считаем минимумы.
+      3) идём по выдаче sort_by_price=True и считаем минимумы.
+      4) FLOOR_EARLY_EXIT: выдача отсортирована по цене, значит первый лот модели —
+         уже её флор. Если первая страница вернула counters (точный набор
+         выставленных моделей), останавливаемся, как только видели их все.
+         Без counters набор не гарантирован → идём до конца выдачи.
     """
     # 1) разведка
     title_probe, models_probe = await discover_models_fast(app, gift_id)
@@ -275,9 +722,15 @@ async def full_scan_floors(app: Client, gift_id: int) -> Tuple[Optional[str], Di
     offset = ""
     page = 0
     improvements = 0
+    expected: Optional[set] = None
 
     while True:
-        resp = await page_resale(app, gift_id, by_price=True, offset=offset, limit=PAGE_LIMIT)
+        first = page == 0 and FLOOR_EARLY_EXIT
+        resp = await page_resale(app, gift_id, by_price=True, offset=offset, limit=PAGE_LIMIT,
+                                 attributes_hash=0 if first else None)
+        if first:
+            listed = models_from_counters(resp)
+            expected = set(listed) if listed else None
         gifts = getattr(resp, "gifts", []) or []
         if not gifts:
             if VERBOSE:
@@ -316,6 +769,11 @@ async def full_scan_floors(app: Client, gift_id: int) -> Tuple[Optional[str], Di
         if VERBOSE and page % 5 == 0:
             log(f"gift_id={gift_id}: стр. {page} | моделей: {len(floors)} | улучшений: {improvements}")
 
+        if expected is not None and expected.issubset(floors):
+            if VERBOSE:
+                log(f"gift_id={gift_id}: все {len(expected)} моделей найдены → ранний стоп (страниц {page})")
+            break
+
         offset = getattr(resp, "next_offset", "")
         if not offset:
             if VERBOSE:
@@ -325,8 +783,100 @@ async def full_scan_floors(app: Client, gift_id: int) -> Tuple[Optional[str], Di
     return title, floors
 
 
+# ─── КАТАЛОГ МОДЕЛЕЙ ─────────────────────────────────────────────────────────
+MODEL_CATALOG: Optional[Dict[int, Dict[str, Any]]] = None
+
+def load_model_catalog(path: str) -> Dict[int, Dict[str, Any]]:
+    """-> { gift_id: {ts, title, hash, models: {name: [doc_id, rarity]}} }"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return {int(k): v for k, v in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+
+def save_model_catalog(path: str, updates: Dict[int, Dict[str, Any]]) -> None:
+    catalog = load_model_catalog(path)
+    catalog.update(updates)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({str(k): v for k, v in catalog.items()}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def model_catalog() -> Dict[int, Dict[str, Any]]:
+    global MODEL_CATALOG
+    if MODEL_CATALOG is None:
+        MODEL_CATALOG = load_model_catalog(MODEL_CATALOG_FILE)
+    return MODEL_CATALOG
+
+def catalog_entry(gift_id: int) -> Optional[Dict[str, Any]]:
+    """Запись каталога подарка, если она не старше MODEL_CATALOG_TTL."""
+    entry = model_catalog().get(gift_id)
+    if entry is not None and time.time() - entry.get("ts", 0) > MODEL_CATALOG_TTL:
+        return None
+    return entry
+
+def refresh_catalog(gift_id: int, entry: Optional[Dict[str, Any]], resp, title: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Ответ с attributes (hash изменился) → новая запись каталога; иначе entry как есть."""
+    by_doc = models_from_attributes(resp)
+    if by_doc is None:
+        return entry
+    if entry is not None and VERBOSE:
+        log(f"gift_id={gift_id}: набор моделей изменился → каталог обновлён")
+    entry = {
+        "ts": time.time(),
+        "title": title or (entry or {}).get("title"),
+        "hash": getattr(resp, "attributes_hash", None),
+        "models": {name: [doc_id, rarity] for doc_id, (name, rarity) in by_doc.items()},
+    }
+    MODEL_CATALOG[gift_id] = entry
+    # Уходит родителю вместе со статистикой подарка (см. MarketRun.on_gift)
+    GIFT_STATS.setdefault(gift_id, {"pages": 0})["catalog"] = entry
+    return entry
+
+async def catalog_models(app: Client, gift_id: int) -> Tuple[Optional[str], Optional[Dict[str, Dict[str, Any]]]]:
+    """
+    Модели подарка из каталога, сверенные одним запросом limit=1:
+    сервер присылает attributes, только если их hash изменился (новая модель),
+    а counters говорят, у каких моделей сейчас есть лоты.
+    -> (title, { model_name: {rarity, doc_id} }) или (None, None), если каталог не помог.
+    """
+    entry = catalog_entry(gift_id)
+    known_hash = entry.get("hash") if entry is not None else None
+
+    resp = await page_resale(app, gift_id, by_price=True, offset="", limit=1,
+                             attributes_hash=known_hash or 0)
+    gifts = getattr(resp, "gifts", []) or []
+    title = getattr(gifts[0], "title", None) if gifts else None
+
+    entry = refresh_catalog(gift_id, entry, resp, title)
+    if entry is None or not entry.get("models"):
+        return None, None
+
+    listed = listed_doc_ids(resp)
+    models = {
+        name: {"doc_id": doc_id, "rarity": rarity}
+        for name, (doc_id, rarity) in entry["models"].items()
+        if listed is None or doc_id in listed
+    }
+    return title or entry.get("title"), models
+
+
 # ─── HYBRID (быстрее, но не 100% гарантия) ──────────────────────────────────
 async def min_price_by_hybrid(app: Client, gift_id: int) -> Tuple[Optional[str], Dict[str, Tuple[Optional[float | int], float]]]:
+    # Быстрый путь: каталог известен → один limit=1 запрос по doc_id на модель
+    title, models = await catalog_models(app, gift_id)
+    if models is not None:
+        floors: Dict[str, Tuple[Optional[float | int], float]] = {}
+
+        async def by_doc(model_name: str, info: Dict[str, Any]):
+            async with VERIFY_SEM:
+                price = await floor_by_doc_id(app, gift_id, info.get("doc_id"))
+                if price is not None:
+                    floors[model_name] = (info.get("rarity"), price)
+
+        await asyncio.gather(*(by_doc(n, i) for n, i in models.items()))
+        return title, floors
+
     title, models = await discover_models_fast(app, gift_id)
     if not title or not models:
         return title, {}
@@ -350,13 +900,21 @@ async def min_price_by_hybrid(app: Client, gift_id: int) -> Tuple[Optional[str],
 
 
 # ─── ОБРАБОТКА ОДНОГО ПОДАРКА ────────────────────────────────────────────────
-async def process_gift(app: Client, gift_id: int) -> List[Dict[str, Any]]:
+async def process_gift(app: Client, gift_id: int) -> List[GiftRow]:
     async with GIFT_SEM:
         t0 = perf_counter()
-        if FLOOR_STRATEGY == "strict":
-            title, floors = await full_scan_floors(app, gift_id)
-        else:
-            title, floors = await min_price_by_hybrid(app, gift_id)
+        try:
+            if FLOOR_STRATEGY == "strict":
+                title, floors = await full_scan_floors(app, gift_id)
+            else:
+                title, floors = await min_price_by_hybrid(app, gift_id)
+        finally:
+            PAGE_CACHE.pop(gift_id, None)
+
+        st = GIFT_STATS.setdefault(gift_id, {"pages": 0})
+        st["seconds"] = round(perf_counter() - t0, 2)
+        GIFT_SECONDS.observe(perf_counter() - t0)
+        GIFT_PAGES.observe(st["pages"])
 
         if not title or not floors:
             if VERBOSE:
@@ -364,12 +922,7 @@ async def process_gift(app: Client, gift_id: int) -> List[Dict[str, Any]]:
             return []
 
         rows = [
-            {
-                "gift": title,
-                "model": model_name,
-                "rarity_per_mille": fmt_permille(rarity),
-                "price": float(price)
-            }
+            GiftRow(title, model_name, permille(rarity), float(price))
             for model_name, (rarity, price) in floors.items()
         ]
 
@@ -379,43 +932,651 @@ async def process_gift(app: Client, gift_id: int) -> List[Dict[str, Any]]:
         return rows
 
 
+# ─── ВЫВОД ───────────────────────────────────────────────────────────────────
+class AtomicJsonlWriter:
+    """Строки JSONL во временный файл; commit() → fsync + rename поверх path."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp = f"{path}.{os.getpid()}.tmp"
+        self.count = 0
+        self._f = open(self.tmp, "wb")
+
+    def write(self, row: GiftRow) -> None:
+        self.write_raw(dump_row(row))
+
+    def write_raw(self, line: bytes) -> None:
+        self._f.write(line + b"\n")
+        self.count += 1
+
+    def commit(self) -> None:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self) -> None:
+        self._f.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+
+# ─── ЧЕКПОИНТ ────────────────────────────────────────────────────────────────
+def load_checkpoint(path: str, ttl: float) -> Dict[int, List[GiftRow]]:
+    """
+    -> { gift_id: rows } для подарков, готовых не раньше ttl секунд назад.
+    Файл заодно ужимается до свежих записей.
+    """
+    if ttl <= 0 or not os.path.exists(path):
+        return {}
+    cutoff = time.time() - ttl
+    fresh: Dict[int, Dict[str, Any]] = {}
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                rec = loads(line)
+            except ValueError:
+                continue        # недописанная строка после падения
+            if rec.get("ts", 0) >= cutoff:
+                fresh[int(rec["gift_id"])] = rec
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for rec in fresh.values():
+            f.write(dumps(rec) + b"\n")
+    os.replace(tmp, path)
+    return {gid: [GiftRow.from_obj(r) for r in rec["rows"]] for gid, rec in fresh.items()}
+
+def append_checkpoint(f, gift_id: int, rows: List[GiftRow], sync: bool = True) -> None:
+    rec = {"gift_id": gift_id, "ts": time.time(), "rows": [row.to_list() for row in rows]}
+    f.write(dumps(rec) + b"\n")
+    f.flush()
+    if sync:
+        os.fsync(f.fileno())
+
+
+# ─── ВЫБОРОЧНЫЙ ОБХОД ────────────────────────────────────────────────────────
+async def resolve_gifts(app: Client, wanted: List[str]) -> Dict[int, Optional[str]]:
+    """
+    Названия (или числовые id) подарков → { gift_id: title }. Сначала по
+    каталогу моделей с диска; каталог подарков запрашиваем, только если
+    чего-то там не нашлось.
+    """
+    catalog = model_catalog()
+    out: Dict[int, Optional[str]] = {}
+    names = set()
+    for w in wanted:
+        if str(w).isdigit():
+            gid = int(w)
+            out[gid] = GIFT_TITLES.get(gid) or (catalog.get(gid) or {}).get("title")
+        else:
+            names.add(str(w))
+
+    def lookup() -> None:
+        known = {**{e.get("title"): gid for gid, e in catalog.items()},
+                 **{t: gid for gid, t in GIFT_TITLES.items()}}
+        for name in list(names):
+            if name in known:
+                out[known[name]] = name
+                names.discard(name)
+
+    lookup()
+    if names:
+        await get_all_gift_ids(app)
+        lookup()
+    if names:
+        log(f"Не найдены в каталоге: {', '.join(sorted(names))}")
+    return out
+
+def copy_other_rows(out: "AtomicJsonlWriter", base_path: str, replaced: set,
+                    only: Optional[set] = None) -> None:
+    """
+    Строки base_path по остальным подаркам — в out как есть, без пересериализации.
+    only — переносить только эти подарки.
+    """
+    try:
+        for row, line in read_lines(base_path):
+            if row.gift not in replaced and (only is None or row.gift in only):
+                out.write_raw(line)
+    except (OSError, ValueError):
+        return
+
+
 # ─── ОБХОД ВСЕГО РЫНКА ───────────────────────────────────────────────────────
-async def parse_market(app: Client) -> List[Dict[str, Any]]:
-    gift_ids = await get_all_gift_ids(app)
-    total = len(gift_ids)
-    log(f"Старт обхода: {total} gifts ({FLOOR_STRATEGY})")
+OnGift = Callable[[int, Optional[List[GiftRow]], Dict[str, Any]], None]
 
-    all_results: List[Dict[str, Any]] = []
-    done = 0
+async def scan_gifts(app: Client, gift_ids: List[int], on_gift: OnGift) -> None:
+    """
+    Обрабатывает подарки; on_gift(gift_id, rows, stats) — по мере готовности.
+    rows=None — подарок не удалось снять (stats["error"] — почему).
+
+    Подарок, упавший на transient/flood ошибке, не держит слот GIFT_SEM
+    повторами, а уходит в отложенную очередь: её проходим после основного
+    обхода, DEFERRED_ROUNDS раз с паузой DEFERRED_DELAY. В последнем проходе
+    transient ошибки повторяются на месте до TRANSIENT_RETRIES_LAST раз.
+
+    Порядок — самые долгие по прошлым прогонам первыми (LPT): GIFT_SEM
+    отдаёт слоты в порядке создания задач, и большие книги не остаются
+    «хвостом» в конце. Их же запросы идут первыми в LIMITER.
+    """
+    costs = gift_costs(gift_ids, load_gift_stats(GIFT_STATS_FILE))
+    gift_ids = sorted(gift_ids, key=costs.__getitem__, reverse=True)
+    GIFT_PRIORITY.update(costs)
+    if gift_ids and VERBOSE:
+        total = sum(costs.values())
+        log(f"План: {len(gift_ids)} gifts ≈ {total:.0f}s работы, "
+            f"≥ {max(total / GIFTS_CONCURRENCY, costs[gift_ids[0]]):.0f}s при {GIFTS_CONCURRENCY} параллельно")
+    deferred: List[int] = []
+
+    async def worker(gid: int, last: bool):
+        if last:
+            _TRANSIENT_RETRIES.set(TRANSIENT_RETRIES_LAST)
+        try:
+            rows = await process_gift(app, gid)
+        except Exception as e:
+            kind = classify_error(e)
+            if kind != "permanent" and not last:
+                GIFTS_DEFERRED.inc()
+                deferred.append(gid)
+                if VERBOSE:
+                    log(f"gift_id={gid}: {rpc_error_type(e) if isinstance(e, RPCError) else e!r} → в отложенные")
+                return
+            if kind == "permanent" and not isinstance(e, RPCError):
+                raise               # не ответ сервера, а ошибка в коде — пусть видно
+            GIFTS_FAILED.inc(error_class=kind)
+            st = GIFT_STATS.pop(gid, {})
+            st["error"] = f"{kind}: {rpc_error_type(e) if isinstance(e, RPCError) else repr(e)}"
+            log(f"gift_id={gid}: не снят ({st['error']})")
+            on_gift(gid, None, st)
+            return
+        on_gift(gid, rows, GIFT_STATS.pop(gid, {}))
+
+    try:
+        await asyncio.gather(*(worker(gid, DEFERRED_ROUNDS == 0) for gid in gift_ids))
+        for n in range(1, DEFERRED_ROUNDS + 1):
+            if not deferred:
+                break
+            batch, deferred = deferred, []
+            log(f"Отложенные: {len(batch)} gifts, проход {n}/{DEFERRED_ROUNDS} через {DEFERRED_DELAY:.0f}s")
+            await asyncio.sleep(DEFERRED_DELAY)
+            await asyncio.gather(*(worker(gid, n == DEFERRED_ROUNDS) for gid in batch))
+    finally:
+        for gid in gift_ids:
+            GIFT_PRIORITY.pop(gid, None)
 
-    async def worker(gid: int):
-        nonlocal done, all_results
-        res = await process_gift(app, gid)
-        all_results.extend(res)
-        done += 1
-        if done % LOG_PROGRESS_EVERY_N_GIFTS == 0:
-            log(f"Прогресс: {done}/{total} gifts | накоплено записей: {len(all_results)}")
 
-    await asyncio.gather(*(worker(gid) for gid in gift_ids))
-    return all_results
+class MarketRun:
+    """
+    Общее для одно- и многосессионного обхода: чекпоинт, прогресс, статистика.
+    Строки не копятся в памяти — сразу уходят в AtomicJsonlWriter.
+
+    Выборочный обход (titles — { gift_id: title } выбранных подарков): чекпоинт
+    не используется, а в конце из base_path дописываются строки остальных
+    подарков. Строки подарка, который снять не удалось, остаются прежними —
+    и в выборочном, и в полном обходе.
+    """
+
+    def __init__(self, gift_ids: List[int], out_path: str, *,
+                 titles: Optional[Dict[int, Optional[str]]] = None, base_path: Optional[str] = None):
+        self.t0 = perf_counter()
+        self.metrics_mark = REGISTRY.mark()
+        self.total = len(gift_ids)
+        self.out = AtomicJsonlWriter(out_path)
+        self.titles = titles
+        self.base_path = base_path or out_path
+        self.replaced: set = set()
+        cached = load_checkpoint(CHECKPOINT_FILE, CHECKPOINT_TTL) if titles is None else {}
+        self.todo: List[int] = []
+        for gid in gift_ids:
+            if gid in cached:
+                for row in cached[gid]:
+                    self.out.write(row)
+                    self.replaced.add(row.gift)
+            else:
+                self.todo.append(gid)
+        self.done = self.total - len(self.todo)
+        self.stats: Dict[int, Dict[str, Any]] = {}
+        self.catalog: Dict[int, Dict[str, Any]] = {}
+        self.failed: Dict[int, str] = {}
+        # Выборочный обход чекпоинт не трогает: он принадлежит полному обходу
+        self._ckpt = open(CHECKPOINT_FILE, "ab") if titles is None else None
+        self._ckpt_synced = time.monotonic()
+
+        log(f"Старт обхода: {self.total} gifts ({FLOOR_STRATEGY}) | из чекпоинта: {self.done}")
+        report_progress(stage="scan", done=self.done, total=self.total, rows=self.out.count)
+
+    def on_gift(self, gid: int, rows: Optional[List[GiftRow]], stats: Dict[str, Any]) -> None:
+        catalog = stats.pop("catalog", None)
+        if catalog is not None:
+            self.catalog[gid] = catalog
+        if rows is None:
+            # Не в чекпоинт: следующий запуск снимет подарок заново
+            self.failed[gid] = stats.pop("error", "")
+        else:
+            if self._ckpt is not None:
+                now = time.monotonic()
+                sync = now - self._ckpt_synced >= CHECKPOINT_SYNC_EVERY
+                append_checkpoint(self._ckpt, gid, rows, sync)
+                if sync:
+                    self._ckpt_synced = now
+            for row in rows:
+                self.out.write(row)
+                self.replaced.add(row.gift)
+            title = self.title(gid)
+            if title:
+                self.replaced.add(title)
+        if stats:
+            self.stats[gid] = stats
+        self.done += 1
+        report_progress(stage="scan", done=self.done, total=self.total, rows=self.out.count,
+                        failed=len(self.failed), gift_id=gid)
+        if self.done % LOG_PROGRESS_EVERY_N_GIFTS == 0:
+            log(f"Прогресс: {self.done}/{self.total} gifts | накоплено записей: {self.out.count}")
+
+    def title(self, gid: int) -> Optional[str]:
+        if self.titles and self.titles.get(gid):
+            return self.titles[gid]
+        return GIFT_TITLES.get(gid) or (self.catalog.get(gid) or model_catalog().get(gid) or {}).get("title")
+
+    def close(self, ok: bool) -> int:
+        """ok → публикуем файл; иначе прежний OUT_FILE остаётся нетронутым."""
+        if self._ckpt is not None:
+            self._ckpt.close()
+        if ok and self.titles is not None:
+            copy_other_rows(self.out, self.base_path, self.replaced)
+        elif ok and self.failed:
+            # Подарок не снят ни в одном проходе: без его прежних строк панель
+            # сочла бы их удалёнными. Название неизвестно — переносим всё,
+            # чего нет в этом обходе.
+            keep = {self.title(gid) for gid in self.failed}
+            copy_other_rows(self.out, self.base_path, self.replaced, only=None if None in keep else keep)
+        if ok:
+            self.out.commit()
+            if self.titles is None:
+                # Обход завершён — следующий должен снять рынок заново
+                try:
+                    os.remove(CHECKPOINT_FILE)
+                except OSError:
+                    pass
+        else:
+            self.out.abort()
+        if self.stats:
+            save_gift_stats(GIFT_STATS_FILE, self.stats)
+        if self.catalog:
+            save_model_catalog(MODEL_CATALOG_FILE, self.catalog)
+        if self.failed:
+            log(f"Не сняты {len(self.failed)} gifts (оставлены строки прошлого снапшота): "
+                + ", ".join(map(str, list(self.failed)[:20])))
+        self.write_summary(ok)
+        return self.out.count
+
+    def write_summary(self, ok: bool) -> None:
+        """RUN_METRICS_FILE: метрики только этого прогона + самые долгие подарки."""
+        slowest = sorted(self.stats.items(), key=lambda kv: kv[1].get("seconds", 0), reverse=True)
+        summary = {
+            "source": "tg",
+            "finished": time.time(),
+            "ok": ok,
+            "strategy": FLOOR_STRATEGY,
+            "wall_seconds": round(perf_counter() - self.t0, 2),
+            "gifts": self.total,
+            "gifts_done": self.done,
+            "rows": self.out.count,
+            "failed_gifts": {str(gid): err for gid, err in self.failed.items()},
+            "metrics": REGISTRY.summary(since=self.metrics_mark),
+            "slowest_gifts": [
+                {"gift_id": gid, **st} for gid, st in slowest[:SLOWEST_GIFTS_IN_SUMMARY]
+            ],
+        }
+        try:
+            write_summary(RUN_METRICS_FILE, summary)
+        except OSError as exc:
+            log(f"Сводка метрик не записана: {exc}")
+
+
+async def parse_market(app: Client, out_path: str = OUT_FILE, gifts: Optional[List[str]] = None,
+                       base_path: Optional[str] = None) -> int:
+    """
+    Полный обход рынка → out_path (JSONL). Возвращает число записей.
+    gifts — только эти подарки (названия или id); строки остальных
+    переносятся из base_path (по умолчанию — прежний out_path).
+    """
+    # Чтение чекпоинта и публикация файла — в потоке: внутри панели
+    # (parser_engine) цикл событий в это время обслуживает запросы
+    if gifts:
+        titles = await resolve_gifts(app, gifts)
+        run = await asyncio.to_thread(MarketRun, list(titles), out_path, titles=titles, base_path=base_path)
+    else:
+        run = await asyncio.to_thread(MarketRun, await get_all_gift_ids(app), out_path)
+    ok = False
+    try:
+        await scan_gifts(app, run.todo, run.on_gift)
+        ok = True
+    finally:
+        count = await asyncio.to_thread(run.close, ok)
+    return count
+
+
+# ─── НЕСКОЛЬКО СЕССИЙ ────────────────────────────────────────────────────────
+def discover_sessions() -> List[str]:
+    """Имена сессий (без .session) рядом с exe; хотя бы SESSION."""
+    found = sorted(str(p.with_suffix("")) for p in EXE_DIR.glob(SESSION_GLOB))
+    return found or [SESSION]
+
+def plan_shards(gift_ids: List[int], n: int, stats: Dict[int, Dict[str, Any]]) -> List[List[int]]:
+    """
+    Жадное LPT-распределение по ожидаемой длительности (gift_costs):
+    самые тяжёлые подарки — первыми, каждый в наименее загруженный шард.
+    """
+    costs = gift_costs(gift_ids, stats)
+    shards: List[List[int]] = [[] for _ in range(n)]
+    loads = [0.0] * n
+    for gid in sorted(gift_ids, key=costs.__getitem__, reverse=True):
+        i = loads.index(min(loads))
+        shards[i].append(gid)
+        loads[i] += costs[gid]
+    return shards
+
+def shard_main(session: str, gift_ids: List[int], out: "mp.Queue") -> None:
+    """Точка входа процесса-шарда: свой Client, свой лимитер, результаты → out."""
+    async def run():
+        async with Client(session, api_id=API_ID, api_hash=API_HASH) as app:
+            await scan_gifts(app, gift_ids, lambda gid, rows, st: out.put(("gift", gid, rows, st)))
+
+    try:
+        asyncio.run(run())
+    except BaseException as exc:
+        out.put(("error", session, repr(exc), None))
+        raise
+    # Метрики шарда живут в его процессе — отдаём родителю для общей сводки
+    out.put(("done", session, REGISTRY.mark(), None))
+
+async def parse_market_sharded(sessions: List[str], out_path: str = OUT_FILE) -> int:
+    # Каталог берём первой сессией и закрываем её: файл сессии нельзя
+    # держать открытым одновременно из двух процессов.
+    async with Client(sessions[0], api_id=API_ID, api_hash=API_HASH) as app:
+        gift_ids = await get_all_gift_ids(app)
+
+    run = MarketRun(gift_ids, out_path)
+    ok = False
+    try:
+        shards = plan_shards(run.todo, len(sessions), load_gift_stats(GIFT_STATS_FILE))
+        ctx = mp.get_context("spawn")
+        out = ctx.Queue()
+        procs = {}
+        for session, ids in zip(sessions, shards):
+            if not ids:
+                continue
+            log(f"Шард {Path(session).name}: {len(ids)} gifts")
+            proc = ctx.Process(target=shard_main, args=(session, ids, out), daemon=True)
+            proc.start()
+            procs[session] = proc
+
+        pending = set(procs)
+        errors: List[str] = []
+        while pending:
+            try:
+                kind, key, payload, st = await asyncio.to_thread(out.get, True, 1.0)
+            except queue.Empty:
+                for session in list(pending):
+                    if not procs[session].is_alive():
+                        pending.discard(session)
+                        errors.append(f"{Path(session).name}: exited with code {procs[session].exitcode}")
+                continue
+            if kind == "gift":
+                run.on_gift(key, payload, st)
+            else:
+                pending.discard(key)
+                if kind == "done":
+                    REGISTRY.merge(payload)
+                if kind == "error":
+                    errors.append(f"{Path(key).name}: {payload}")
+
+        for proc in procs.values():
+            proc.join()
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        ok = True
+    finally:
+        count = run.close(ok)
+    return count
+
+
+# ─── НАБЛЮДЕНИЕ ЗА ФЛОРАМИ ────────────────────────────────────────────────────
+class FloorWatch:
+    """
+    Держит строки последнего снапшота и точечно обновляет флоры:
+      • первая страница по цене — точный флор каждой модели, попавшей на неё
+        (выдача отсортирована по цене, первый лот модели и есть её флор).
+        Модели нет на странице, а её старый флор дешевле последнего лота —
+        тот лот продан: модель проверяется по doc_id вне очереди. counters
+        без модели — лотов нет, строка уходит;
+      • limit=1 по doc_id — флор модели дороже первой страницы (ловит и рост).
+    Снапшот переписывается атомарно не чаще раза в flush_every сек; событие
+    прогресса stage="watch" называет изменённые подарки (gifts) — панель
+    пересобирает только их. Если файл подменил полный обход — перечитываем
+    его, свои правки бросаем.
+    """
+
+    def __init__(self, out_path: str, flush_every: float = WATCH_FLUSH_EVERY):
+        self.out_path = out_path
+        self.flush_every = flush_every
+        self.rows: Dict[Tuple[str, str], GiftRow] = {}
+        self.sig: Optional[Tuple[int, int]] = None
+        self.changes = 0
+        self.changed_gifts: set = set()
+        self.suspects: deque = deque()      # (gift_id, model) — проверить первыми
+        self.models: deque = deque()        # ротация (gift_id, model)
+        self.gifts: deque = deque()         # ротация gift_id
+        self.catalog: Dict[int, Dict[str, Any]] = {}
+        self.reload()
+
+    def _file_sig(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.out_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def reload(self) -> None:
+        rows: Dict[Tuple[str, str], GiftRow] = {}
+        try:
+            for r, _ in read_lines(self.out_path):
+                rows[r.key] = r
+        except (OSError, ValueError):
+            pass
+        self.rows = rows
+        self.sig = self._file_sig()
+        self.changes = 0
+        self.changed_gifts.clear()
+        self.models.clear()
+        log(f"Наблюдение: {len(rows)} строк из {self.out_path}")
+
+    def set_floor(self, title: str, model: str, rarity: Optional[float | int], price: float) -> None:
+        row = self.rows.get((title, model))
+        if row is None:
+            self.rows[(title, model)] = GiftRow(title, model, permille(rarity), float(price))
+            kind = "new"
+        elif row.price != price:
+            kind = "drop" if price < row.price else "rise"
+            row.price = float(price)
+        else:
+            return
+        WATCH_CHANGES.inc(kind=kind)
+        self.changes += 1
+        self.changed_gifts.add(title)
+        if VERBOSE:
+            log(f"{title} — {model}: {kind} → {price:g}")
+
+    def drop(self, title: str, model: str) -> None:
+        if self.rows.pop((title, model), None) is not None:
+            WATCH_CHANGES.inc(kind="gone")
+            self.changes += 1
+            self.changed_gifts.add(title)
+
+    def flush(self) -> None:
+        if self.catalog:
+            save_model_catalog(MODEL_CATALOG_FILE, self.catalog)
+            self.catalog.clear()
+        if not self.changes:
+            return
+        if self._file_sig() != self.sig:
+            self.reload()
+            return
+        out = AtomicJsonlWriter(self.out_path)
+        for row in self.rows.values():
+            out.write(row)
+        out.commit()
+        self.sig = self._file_sig()
+        report_progress(stage="watch", changes=self.changes, rows=out.count, gifts=sorted(self.changed_gifts))
+        self.changes = 0
+        self.changed_gifts.clear()
+
+    async def poll_page(self, app: Client, gift_id: int) -> None:
+        WATCH_POLLS.inc(kind="page")
+        entry = catalog_entry(gift_id)
+        try:
+            resp = await page_resale(app, gift_id, by_price=True, offset="", limit=PAGE_LIMIT,
+                                     attributes_hash=(entry or {}).get("hash") or 0)
+        finally:
+            PAGE_CACHE.pop(gift_id, None)   # кэш — на обработку подарка, не на часы
+        gifts = getattr(resp, "gifts", []) or []
+        title = getattr(gifts[0], "title", None) if gifts else None
+        new_entry = refresh_catalog(gift_id, entry, resp, title)
+        GIFT_STATS.pop(gift_id, None)
+        if new_entry is not entry:
+            self.catalog[gift_id] = new_entry
+        title = title or (new_entry or {}).get("title")
+        if not title:
+            return
+
+        floors: Dict[str, Tuple[Optional[float | int], float]] = {}
+        for g in gifts:
+            p = extract_price(g)
+            name, rarity, _ = pick_model_attr(getattr(g, "attributes", None))
+            if name and p is not None and name not in floors:
+                floors[name] = (rarity, p)
+        for name, (rarity, p) in floors.items():
+            self.set_floor(title, name, rarity, p)
+
+        whole_book = not getattr(resp, "next_offset", "")
+        last_price = extract_price(gifts[-1]) if gifts else None
+        listed = listed_doc_ids(resp)
+        doc_ids = {name: v[0] for name, v in ((new_entry or {}).get("models") or {}).items()}
+        for (t, name), row in list(self.rows.items()):
+            if t != title or name in floors:
+                continue
+            # Вне первой страницы модель уходит, только если counters её точно не знают
+            doc_id = doc_ids.get(name)
+            if whole_book or (listed is not None and doc_id and doc_id not in listed):
+                self.drop(title, name)
+            elif last_price is not None and row.price < last_price:
+                self.suspects.append((gift_id, name))
+
+    async def poll_model(self, app: Client, gift_id: int, model: str) -> None:
+        WATCH_POLLS.inc(kind="model")
+        entry = catalog_entry(gift_id) or {}
+        doc_id, rarity = (entry.get("models") or {}).get(model, (None, None))
+        title = entry.get("title")
+        if not doc_id or not title:
+            return
+        # Ошибка — не «лотов нет»: строка остаётся, run() идёт дальше по кругу
+        try:
+            price = await floor_by_doc_id(app, gift_id, doc_id, raise_permanent=True)
+        finally:
+            GIFT_STATS.pop(gift_id, None)
+        if price is None:
+            self.drop(title, model)
+        else:
+            self.set_floor(title, model, rarity, price)
+
+    def _next_model(self) -> Optional[Tuple[int, str]]:
+        if self.suspects:
+            return self.suspects.popleft()
+        if not self.models:
+            tracked = {key for key in self.rows}
+            for gift_id, entry in model_catalog().items():
+                for name in entry.get("models") or {}:
+                    if (entry.get("title"), name) in tracked:
+                        self.models.append((gift_id, name))
+        return self.models.popleft() if self.models else None
+
+    async def run(self, app: Client) -> None:
+        interval = 1.0 / WATCH_RPS
+        credit = 0.0
+        last_flush = time.monotonic()
+        log(f"Наблюдение: до {WATCH_RPS:g} запросов/с, снапшот → {self.out_path}")
+        try:
+            while True:
+                t0 = time.monotonic()
+                if self._file_sig() != self.sig:
+                    self.reload()
+                credit += WATCH_MODEL_SHARE
+                target = self._next_model() if credit >= 1 else None
+                if target is None:
+                    # Моделей нет (каталог пуст, названия не сошлись) — кредит не копим,
+                    # иначе потом он уйдёт пачкой запросов по моделям без страниц
+                    credit = min(credit, 1.0)
+                try:
+                    if target is not None:
+                        credit -= 1
+                        await self.poll_model(app, *target)
+                    else:
+                        if not self.gifts:
+                            self.gifts.extend(await get_all_gift_ids(app))
+                        if self.gifts:
+                            await self.poll_page(app, self.gifts.popleft())
+                except RPCError as e:
+                    log(f"Наблюдение: {rpc_error_type(e)} → дальше по кругу")
+                if time.monotonic() - last_flush >= self.flush_every:
+                    await asyncio.to_thread(self.flush)
+                    last_flush = time.monotonic()
+                await asyncio.sleep(max(0.0, interval - (time.monotonic() - t0)))
+        finally:
+            self.flush()
+
+async def watch_market(app: Client, out_path: str = OUT_FILE, flush_every: float = WATCH_FLUSH_EVERY) -> None:
+    """Режим наблюдения до отмены задачи / Ctrl+C."""
+    await FloorWatch(out_path, flush_every).run(app)
 
 
 # ─── ВХОД ────────────────────────────────────────────────────────────────────
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    ap = argparse.ArgumentParser(description="TG Market resale floors")
+    ap.add_argument("--watch", action="store_true",
+                    help="после обхода (или сразу, если снапшот есть) следить за флорами")
+    ap.add_argument("--out", default=OUT_FILE, help="файл снапшота (JSONL)")
+    ap.add_argument("--flush-every", type=float, default=WATCH_FLUSH_EVERY,
+                    help="при --watch: сек между перезаписями снапшота")
+    ap.add_argument("--gift", action="append", default=[],
+                    help="обойти только этот подарок (название или id; можно несколько раз)")
+    ap.add_argument("--base", default=None,
+                    help="откуда взять строки остальных подарков при --gift (по умолчанию --out)")
+    return ap.parse_args(argv)
+
 async def main():
+    args = parse_args()
     t0 = perf_counter()
-    async with Client(SESSION, api_id=API_ID, api_hash=API_HASH) as app:
-        data = await parse_market(app)
-        if JSONL:
-            with open(OUT_FILE, "w", encoding="utf-8") as f:
-                for row in data:
-                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
-        else:
-            with open(OUT_FILE, "w", encoding="utf-8") as f:
-                if PRETTY_JSON:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                else:
-                    json.dump(data, f, ensure_ascii=False)
-        log(f"✅ Готово: {len(data)} записей → {OUT_FILE} | {perf_counter() - t0:.1f}s")
+    sessions = discover_sessions()
+    if args.watch:
+        async with Client(sessions[0], api_id=API_ID, api_hash=API_HASH) as app:
+            if not os.path.exists(args.out):
+                await parse_market(app, args.out)
+            await watch_market(app, args.out, args.flush_every)
+        return
+    if args.gift:
+        async with Client(sessions[0], api_id=API_ID, api_hash=API_HASH) as app:
+            count = await parse_market(app, args.out, args.gift, args.base)
+    elif len(sessions) > 1:
+        log(f"Сессий: {len(sessions)} → шардированный обход")
+        count = await parse_market_sharded(sessions, args.out)
+    else:
+        async with Client(sessions[0], api_id=API_ID, api_hash=API_HASH) as app:
+            count = await parse_market(app, args.out)
+    log(f"✅ Готово: {count} записей → {args.out} | {perf_counter() - t0:.1f}s")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    mp.freeze_support()
+    asyncio.run(main())
@@ -0,0 +1,206 @@
+# gifts_parcers/parser_metrics.py
+"""
+Счётчики и гистограммы без внешних зависимостей.
+
+Один реестр REGISTRY на процесс: парсеры пишут в него из mt_invoke,
+process_gift и загрузки Thermos, панель — из load_data/индекса, когда
+парсеры запущены в её процессе, всё видно на /metrics. Формат —
+текстовый Prometheus exposition (version 0.0.4).
+
+Для сводки одного прогона: mark = REGISTRY.mark() в начале,
+REGISTRY.summary(since=mark) в конце — разница только за этот прогон.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# Границы по умолчанию: секунды запроса/подарка
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+# ─── МЕТРИКИ ─────────────────────────────────────────────────────────────────
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def raw(self) -> Dict[LabelKey, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, raw: Dict[LabelKey, float]) -> None:
+        with self._lock:
+            for key, v in raw.items():
+                self._values[key] = self._values.get(key, 0.0) + v
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in sorted(self.raw().items())]
+
+    def summarize(self, now: Dict[LabelKey, float], before: Dict[LabelKey, float]) -> Dict[str, float]:
+        out = {}
+        for key, v in now.items():
+            d = v - before.get(key, 0.0)
+            if d:
+                out[_fmt_labels(key) or "total"] = round(d, 3)
+        return out
+
+
+class Histogram:
+    """Накопительные корзины, сумма и число наблюдений на каждый набор меток."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key → [счётчики по корзинам..., sum, count]
+        self._values: Dict[LabelKey, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def raw(self) -> Dict[LabelKey, List[float]]:
+        with self._lock:
+            return {k: list(v) for k, v in self._values.items()}
+
+    def merge(self, raw: Dict[LabelKey, List[float]]) -> None:
+        with self._lock:
+            for key, other in raw.items():
+                row = self._values.setdefault(key, [0.0] * len(other))
+                for i, v in enumerate(other):
+                    row[i] += v
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, row in sorted(self.raw().items()):
+            for bound, n in zip(self.buckets, row):
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, (('le', _fmt_value(bound)),))} {_fmt_value(n)}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {_fmt_value(row[-2])}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {_fmt_value(row[-1])}")
+        return lines
+
+    def summarize(self, now: Dict[LabelKey, List[float]], before: Dict[LabelKey, List[float]]) -> Dict[str, Dict[str, float]]:
+        out = {}
+        for key, row in now.items():
+            prev = before.get(key)
+            total = row[-2] - (prev[-2] if prev else 0.0)
+            count = row[-1] - (prev[-1] if prev else 0.0)
+            if count:
+                out[_fmt_labels(key) or "total"] = {
+                    "count": int(count),
+                    "sum": round(total, 3),
+                    "avg": round(total / count, 4),
+                }
+        return out
+
+
+# ─── РЕЕСТР ──────────────────────────────────────────────────────────────────
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def mark(self) -> Dict[str, Any]:
+        """Текущее состояние — точка отсчёта для summary(since=...) и merge()."""
+        return {name: metric.raw() for name, metric in self._metrics.items()}
+
+    def merge(self, raw: Dict[str, Any]) -> None:
+        """Прибавляет mark() другого процесса (шарды сканера)."""
+        for name, values in raw.items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.merge(values)
+
+    def summary(self, since: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        since = since or {}
+        out = {}
+        for name, metric in sorted(self._metrics.items()):
+            values = metric.summarize(metric.raw(), since.get(name, {}))
+            if values:
+                out[name] = values
+        return out
+
+
+REGISTRY = Registry()
+
+
+def write_summary(path: str, summary: Dict[str, Any]) -> None:
+    """Сводка прогона в JSON, атомарно (temp + rename)."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
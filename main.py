@@ -1,16 +1,43 @@
 # main.py
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from jinja2 import Environment, FileSystemLoader
 import uvicorn
+import base64
+import gzip
+import hashlib
 import json
+import math
+import os
 import sys
+import time
+import uuid
 import shutil
 import asyncio
+import heapq
+import threading
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs
 
+from parser_engine import EngineUnavailable, ParserEngine
+from price_history import PriceHistory
+from shared_state import FileLock, SharedSnapshot, read_json, write_json
+
+# Спреды и top-K на NumPy (analytics.py); без numpy панель работает, /api/analytics → 503
+try:
+    import analytics
+except ImportError:
+    analytics = None
+
+# brotli для главной страницы — если установлен; gzip есть всегда
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # BASE_DIR = Path(__file__).resolve().parent
 if getattr(sys, "frozen", False):
@@ -21,98 +48,1179 @@ else:
 PARSERS_DIR = BASE_DIR / "gifts_parcers"
 THERMOS_FILE = BASE_DIR / "thermos_gifts.json"
 TG_FILE = BASE_DIR / "tg_gifts_resale.json"
+HISTORY_DB = BASE_DIR / "price_history.sqlite3"
 # Исполняемые файлы парсеров (учитываем расширение под Windows)
 EXE_SUFFIX = ".exe" if sys.platform.startswith("win") else ""
 TG_PARSER = PARSERS_DIR / f"parce_tg_market_kurigram{EXE_SUFFIX}"
 THERMOS_PARSER = PARSERS_DIR / f"parce_thermos_gifts{EXE_SUFFIX}"
+# "inprocess" — парсеры как модули в цикле событий панели с тёплым Client;
+# "subprocess" — запуск exe на каждое обновление (и запасной путь для inprocess)
+PARSER_MODE = "inprocess"
+# Режим наблюдения TG (см. FloorWatch в парсере): в inprocess панель держит его
+# фоновой задачей и правит TG_FILE на месте. Без inprocess можно запустить
+# exe с --watch --out <путь к TG_FILE> — панель подхватит изменения файла сама.
+TG_WATCH = False
+# Как часто проверять файлы снапшотов и рассылать диффы открытым панелям, сек
+SNAPSHOT_POLL_EVERY = 2.0
+# Воркеры uvicorn (за прокси). Общее между ними — файлы ниже: снапшот склейки,
+# блокировки сборки снапшота, /update и наблюдения TG, состояние текущего /update.
+WORKERS = 1
+HOST = "127.0.0.1"
+PORT = 8000
+SHARED_SNAPSHOT_FILE = BASE_DIR / "panel_snapshot.bin"
+SNAPSHOT_LOCK_FILE = BASE_DIR / "panel_snapshot.lock"
+UPDATE_LOCK_FILE = BASE_DIR / "panel_update.lock"
+WATCH_LOCK_FILE = BASE_DIR / "panel_watch.lock"
+JOB_STATE_FILE = BASE_DIR / "panel_update_job.json"
+JOB_STATE_WRITE_EVERY = 1.0         # сек: прогресс в JOB_STATE_FILE не чаще; смена стадии и итог — сразу
+
+# Реестр метрик общий с парсерами (gifts_parcers/parser_metrics.py): в режиме
+# inprocess их запросы к Telegram и Thermos видны на /metrics панели.
+# Сводки прогонов exe лежат рядом с ними — отдаём через /api/runs.
+sys.path.insert(0, str(PARSERS_DIR))
+from parser_metrics import REGISTRY
+# Формат строк парсеров (GiftRow, JSONL-массивы; см. gifts_parcers/gift_rows.py)
+from gift_rows import parse_rarity, read_rows
+RUN_SUMMARIES = {"tg": "tg_run_metrics.json", "thermos": "thermos_run_metrics.json"}
+
+LOAD_DATA_SECONDS = REGISTRY.histogram("panel_load_data_seconds", "History ingest and join of both sources")
+INDEX_BUILD_SECONDS = REGISTRY.histogram("panel_index_build_seconds", "Presorted /api/gifts index build")
+RENDER_SECONDS = REGISTRY.histogram("panel_render_seconds", "Response build time by route")
+REFRESH_SECONDS = REGISTRY.histogram("panel_refresh_seconds", "One source refresh in /update by source and mode")
 
 app = FastAPI()
 
-app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
+# ─── HTTP-КЭШ ────────────────────────────────────────────────────────────────
+# Ссылки на /static строит static_url(): ?v=<хэш содержимого>. Такие ответы
+# кэшируются браузером навсегда — новый файл получит новый URL. Без ?v (или
+# со старым) — no-cache: браузер переспрашивает по ETag и получает 304.
+STATIC_DIR = BASE_DIR / "static"
+STATIC_MAX_AGE = 365 * 86400
+_static_hashes: Dict[str, Tuple[Any, str]] = {}
+
+
+def static_hash(rel: str) -> str:
+    """Хэш содержимого файла в static/; пересчитывается, только если файл сменился."""
+    path = STATIC_DIR / rel
+    sig = file_sig(path)
+    cached = _static_hashes.get(rel)
+    if cached is not None and cached[0] == sig:
+        return cached[1]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    digest = h.hexdigest()[:12]
+    _static_hashes[rel] = (sig, digest)
+    return digest
+
+
+def static_url(rel: str) -> str:
+    return f"/static/{rel}?v={static_hash(rel)}"
+
+
+class HashedStaticFiles(StaticFiles):
+    async def get_response(self, path: str, scope) -> Response:
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            v = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("v")
+            if v and v[0] == static_hash(path):
+                response.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE}, immutable"
+            else:
+                response.headers["Cache-Control"] = "no-cache"
+        return response
+
+
+app.mount("/static", HashedStaticFiles(directory=STATIC_DIR), name="static")
 
 templates = Environment(loader=FileSystemLoader(BASE_DIR / "templates"))
+templates.globals["static_url"] = static_url
 
 # Здесь можно будет позже подтягивать реальные данные
 DATA_FILE = "gifts_data.json"
 
-def load_data():
-    thermos_data = []
-    tg_data = []
-    if THERMOS_FILE.exists():
-        with open(THERMOS_FILE, "r", encoding="utf-8") as f:
-            thermos_data = json.load(f)
-    if TG_FILE.exists():
-        with open(TG_FILE, "r", encoding="utf-8") as f:
-            tg_data = json.load(f)
+history = PriceHistory(str(HISTORY_DB))
 
-    thermos_map = {(g["gift"], g["model"]): g.get("price") for g in thermos_data}
-    tg_map = {(g["gift"], g["model"]): g.get("price") for g in tg_data}
+
+def ingest_file(source: str, path: Path) -> bool:
+    """Новый файл парсера → снапшот в истории. True, если что-то загрузили."""
+    sig = file_sig(path)
+    if sig is None:
+        return False
+    mtime_ns, size = sig
+    return history.ingest(source, read_rows(str(path)), ts=mtime_ns / 1e9, sig=f"{mtime_ns}:{size}") is not None
+
+
+def load_data(gifts: Optional[Iterable[str]] = None):
+    """Склейка обоих источников; gifts — только строки этих подарков."""
+    ingested = [ingest_file("thermos", THERMOS_FILE), ingest_file("tg", TG_FILE)]
+    if any(ingested):
+        history.compact()
 
     # Show only gifts present in both sources
-    keys = sorted(set(thermos_map) & set(tg_map))
     result = []
-    for gift, model in keys:
-        t_price = thermos_map[(gift, model)]
-        tg_price = tg_map[(gift, model)]
-
+    for gift, model, t_price, tg_price, rarity in history.joined("thermos", "tg", gifts=gifts):
         result.append(
             {
+                "gift": gift,
+                "model": model,
                 "tg_name": f"{gift} — {model}",
                 "thermos_price": t_price,
                 "tgmarket_price": tg_price,
+                "rarity_per_mille": parse_rarity(rarity),   # в старой истории — строка "2,5"
             }
         )
     return result
 
+
+# ─── ИНДЕКС ДЛЯ /api/gifts ───────────────────────────────────────────────────
+def _price_ratio(r: Dict[str, Any]) -> Optional[float]:
+    # Разница в % при любом курсе монотонна по tg/thermos:
+    # delta = (tg / rate - thermos) / thermos = ratio / rate - 1
+    t, g = r.get("thermos_price"), r.get("tgmarket_price")
+    if not t or g is None:
+        return None
+    return g / t
+
+
+SORT_KEYS = {
+    "delta": _price_ratio,
+    "thermos_price": lambda r: r.get("thermos_price"),
+    "tgmarket_price": lambda r: r.get("tgmarket_price"),
+    "rarity": lambda r: r.get("rarity_per_mille"),
+    "name": lambda r: (r["gift"], r["model"]),
+}
+
+
+# Метка строки в порядке сортировки: (значение ключа, gift, model)
+Mark = Tuple[Any, str, str]
+
+
+@dataclass(frozen=True)
+class GiftIndex:
+    rows: List[Dict[str, Any]]
+    names: List[str]                            # "gift — model" в нижнем регистре
+    ratios: List[Optional[float]]
+    values: Dict[str, List[Any]]                # ключ сортировки → значения по строкам
+    orders: Dict[Tuple[str, bool], List[int]]   # (ключ, desc) → порядок строк
+
+    def mark(self, sort: str, i: int) -> Mark:
+        r = self.rows[i]
+        return self.values[sort][i], r["gift"], r["model"]
+
+    def _after(self, sort: str, desc: bool, i: int, mark: Mark) -> bool:
+        """Строка i идёт в порядке (sort, desc) строго после метки."""
+        value, gift, model = mark
+        v, g, m = self.mark(sort, i)
+        if value is None:
+            return v is None and (g, m) > (gift, model)
+        if v is None:
+            return True
+        return (v, g, m) < (value, gift, model) if desc else (v, g, m) > (value, gift, model)
+
+    def seek(self, sort: str, desc: bool, mark: Mark) -> int:
+        """
+        Позиция первой строки после метки. Метка переживает смену снапшота:
+        строки, которых больше нет или которые сменили цену, не сбивают выдачу.
+        """
+        order = self.orders[(sort, desc)]
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._after(sort, desc, order[mid], mark):
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def query(
+        self,
+        *,
+        sort: str,
+        desc: bool,
+        start: int,
+        limit: int,
+        q: str = "",
+        gift: str = "",
+        model: str = "",
+        min_ratio: Optional[float] = None,
+        price_range: Tuple[Optional[float], Optional[float]] = (None, None),
+    ) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """Строки страницы и позиция следующей (None — конец выдачи)."""
+        order = self.orders[(sort, desc)]
+        q, gift, model = q.lower(), gift.lower(), model.lower()
+        lo, hi = price_range
+        out: List[Dict[str, Any]] = []
+        pos = start
+        while pos < len(order) and len(out) < limit:
+            i = order[pos]
+            pos += 1
+            r = self.rows[i]
+            if q and q not in self.names[i]:
+                continue
+            if gift and gift not in r["gift"].lower():
+                continue
+            if model and model not in r["model"].lower():
+                continue
+            if min_ratio is not None:
+                ratio = self.ratios[i]
+                if ratio is None or ratio < min_ratio:
+                    continue
+            price = r.get("thermos_price")
+            if lo is not None and (price is None or price < lo):
+                continue
+            if hi is not None and (price is None or price > hi):
+                continue
+            out.append(r)
+        return out, (pos if pos < len(order) else None)
+
+
+def build_index(rows: List[Dict[str, Any]]) -> GiftIndex:
+    """
+    Все порядки сортировки строятся один раз на снапшот; None — всегда в конце.
+    Равные значения упорядочены по (gift, model) — порядок полный, курсор
+    /api/gifts находит в нём своё место и в следующем снапшоте.
+    """
+    all_values: Dict[str, List[Any]] = {}
+    orders: Dict[Tuple[str, bool], List[int]] = {}
+    for key, fn in SORT_KEYS.items():
+        values = all_values[key] = [fn(r) for r in rows]
+        present = sorted(
+            (i for i, v in enumerate(values) if v is not None),
+            key=lambda i: (values[i], rows[i]["gift"], rows[i]["model"]),
+        )
+        missing = sorted(
+            (i for i, v in enumerate(values) if v is None),
+            key=lambda i: (rows[i]["gift"], rows[i]["model"]),
+        )
+        orders[(key, False)] = present + missing
+        orders[(key, True)] = present[::-1] + missing
+    return GiftIndex(
+        rows=rows,
+        names=[r["tg_name"].lower() for r in rows],
+        ratios=[_price_ratio(r) for r in rows],
+        values=all_values,
+        orders=orders,
+    )
+
+
+def list_gif_files() -> List[str]:
+    gifs_dir = STATIC_DIR / "gifs"
+    if not gifs_dir.exists():
+        return []
+    return [static_url(f"gifs/{p.name}") for p in sorted(gifs_dir.iterdir()) if p.suffix.lower() == ".gif"]
+
+
+# ─── СНАПШОТ ДАННЫХ ──────────────────────────────────────────────────────────
+# Склеенные строки держим в памяти процесса и пересобираем только когда
+# меняется mtime/size одного из файлов или после /update.
+# При нескольких воркерах склейку делает один (под SNAPSHOT_LOCK_FILE) и
+# публикует в SHARED_SNAPSHOT_FILE; остальные берут строки оттуда и строят
+# у себя только индекс — без разбора файлов парсеров и запросов к истории.
+FileSig = Optional[Tuple[int, int]]
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    version: Tuple[FileSig, FileSig]
+    rows: List[Dict[str, Any]]
+    gif_files: List[str]
+    index: GiftIndex
+    table: Optional["analytics.SpreadTable"] = None
+    generation: int = 0                 # номер публикации в SHARED_SNAPSHOT_FILE
+
+    @property
+    def tag(self) -> str:
+        # Не hash(): до Python 3.12 hash(None) свой в каждом процессе, а тег
+        # должен совпадать у всех воркеров
+        return hashlib.sha1(repr(self.version).encode("ascii")).hexdigest()[:12]
+
+
+_snapshot: Optional[Snapshot] = None
+_snapshot_lock = threading.Lock()
+_build_lock = FileLock(SNAPSHOT_LOCK_FILE)
+shared_snapshot = SharedSnapshot(SHARED_SNAPSHOT_FILE)
+
+
+def file_sig(path: Path) -> FileSig:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _row_key(r: Dict[str, Any]) -> Tuple[str, str]:
+    return r["gift"], r["model"]
+
+
+def _make_snapshot(version, rows: List[Dict[str, Any]], generation: int) -> Snapshot:
+    with INDEX_BUILD_SECONDS.time():
+        index = build_index(rows)
+        table = analytics.build_table(rows) if analytics is not None else None
+    return Snapshot(
+        version=version, rows=rows, gif_files=list_gif_files(), index=index, table=table, generation=generation,
+    )
+
+
+def _broadcast_diff(snap: Snapshot, old: List[Dict[str, Any]], new: List[Dict[str, Any]]) -> None:
+    diff = diff_rows(old, new)
+    if diff["added"] or diff["removed"] or diff["changed"]:
+        broadcast({"type": "diff", "snapshot": snap.tag, **diff})
+
+
+def _adopt_shared(version=None) -> Optional[Snapshot]:
+    """
+    Подхватывает публикацию другого воркера, если она новее нашей (и, если
+    задан version, собрана из тех же файлов). Звать под _snapshot_lock.
+    """
+    global _snapshot
+    prev = _snapshot
+    header = shared_snapshot.header()
+    if header is None or (prev is not None and header["generation"] <= prev.generation):
+        return None
+    if version is not None and _sig_tuple(header["version"]) != version:
+        return None
+    got = shared_snapshot.load()
+    if got is None:
+        return None
+    header, rows = got
+    snap = _make_snapshot(_sig_tuple(header["version"]), rows, header["generation"])
+    _snapshot = snap
+    if prev is not None:
+        gifts = header.get("gifts")
+        if gifts and header["generation"] == prev.generation + 1:
+            # выборочная публикация сразу после нашей — сравниваем только её подарки
+            gifts = set(gifts)
+            _broadcast_diff(snap, [r for r in prev.rows if r["gift"] in gifts], [r for r in rows if r["gift"] in gifts])
+        else:
+            _broadcast_diff(snap, prev.rows, rows)
+    return snap
+
+
+def _sig_tuple(version: List[Any]) -> Tuple[FileSig, FileSig]:
+    return tuple(tuple(sig) if sig is not None else None for sig in version)
+
+
+def get_snapshot(force: bool = False, gifts: Optional[Iterable[str]] = None) -> Snapshot:
+    """
+    Текущий снапшот. Читатели получают либо старый, либо полностью
+    собранный новый объект — подмена одной ссылкой.
+
+    gifts — после выборочного /update изменились только эти подарки: склейка
+    пересчитывается для них, остальные строки берутся из прошлого снапшота.
+    Если с прошлого снапшота сменились оба файла — полная пересборка.
+    """
+    gifts = set(gifts) if gifts else None
+    global _snapshot
+    version = (file_sig(THERMOS_FILE), file_sig(TG_FILE))
+    snap = _snapshot
+    if not force and snap is not None and snap.version == version:
+        return snap
+    with _snapshot_lock:
+        snap = _snapshot
+        if not force and snap is not None and snap.version == version:
+            return snap
+        if not force:
+            snap = _adopt_shared(version)
+            if snap is not None:
+                return snap
+        with _build_lock:
+            # Пока ждали блокировку, снапшот мог собрать другой воркер
+            snap = _adopt_shared(None if force else version)
+            if snap is not None and not force:
+                return snap
+            prev = _snapshot
+            with LOAD_DATA_SECONDS.time():
+                if gifts is not None and prev is not None and sum(a != b for a, b in zip(version, prev.version)) <= 1:
+                    fresh = load_data(gifts)
+                    kept = [r for r in prev.rows if r["gift"] not in gifts]
+                    # обе части упорядочены по (gift, model), как и joined()
+                    rows = list(heapq.merge(kept, fresh, key=_row_key))
+                    old_part = [r for r in prev.rows if r["gift"] in gifts]
+                else:
+                    rows = load_data()
+                    fresh, old_part = rows, prev.rows if prev is not None else []
+            header = shared_snapshot.header()
+            generation = (header["generation"] if header else 0) + 1
+            snap = _make_snapshot(version, rows, generation)
+            shared_snapshot.publish(
+                {"generation": generation, "version": version, "gifts": sorted(gifts) if gifts else None},
+                rows,
+            )
+            _snapshot = snap
+    if prev is not None:
+        _broadcast_diff(snap, old_part, fresh)
+    return snap
+
+
+# ─── ЛЕНТА ИЗМЕНЕНИЙ (WebSocket) ─────────────────────────────────────────────
+# Открытым панелям уходят только отличия нового снапшота от прошлого.
+DIFF_FIELDS = ("thermos_price", "tgmarket_price", "rarity_per_mille")
+# Диффов в очереди одного клиента; переполнилась — клиент не успевает читать,
+# его соединение закрывается (панель переподключится и перечитает таблицу)
+FEED_QUEUE_MAX = 64
+FEED_DROPPED = REGISTRY.counter("panel_feed_dropped_total", "Change feed clients closed for falling behind")
+
+_feed_clients: List[asyncio.Queue] = []
+_feed_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def diff_rows(old: List[Dict[str, Any]], new: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    old_map = {(r["gift"], r["model"]): r for r in old}
+    new_map = {(r["gift"], r["model"]): r for r in new}
+    added = [r for k, r in new_map.items() if k not in old_map]
+    removed = [{"gift": k[0], "model": k[1]} for k in old_map if k not in new_map]
+    changed = [
+        r for k, r in new_map.items()
+        if k in old_map and any(r.get(f) != old_map[k].get(f) for f in DIFF_FIELDS)
+    ]
+    return {"added": added, "removed": removed, "changed": changed}
+
+
+def broadcast(message: Dict[str, Any]) -> None:
+    """Можно звать из любого потока (снапшот пересобирается и в to_thread)."""
+    loop = _feed_loop
+    if loop is None:
+        return
+    for q in list(_feed_clients):
+        loop.call_soon_threadsafe(_offer, q, message)
+
+
+def _offer(q: asyncio.Queue, message: Dict[str, Any]) -> None:
+    try:
+        q.put_nowait(message)
+    except asyncio.QueueFull:
+        # Хвост выбрасываем, None — сигнал закрыть соединение
+        while not q.empty():
+            q.get_nowait()
+        q.put_nowait(None)
+
+
+@app.websocket("/ws/changes")
+async def changes_feed(ws: WebSocket):
+    global _feed_loop
+    await ws.accept()
+    _feed_loop = asyncio.get_running_loop()
+    q: asyncio.Queue = asyncio.Queue(maxsize=FEED_QUEUE_MAX)
+    _feed_clients.append(q)
+
+    async def drain():
+        # входящие нам не нужны — ждём только закрытия сокета
+        while True:
+            await ws.receive_text()
+
+    receiver = asyncio.create_task(drain())
+    try:
+        while not receiver.done():
+            getter = asyncio.create_task(q.get())
+            await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                break
+            message = getter.result()
+            if message is None:
+                FEED_DROPPED.inc()
+                await ws.close(code=1013)
+                break
+            await ws.send_json(message)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        _feed_clients.remove(q)
+        if receiver.done() and not receiver.cancelled():
+            # Забираем исход задачи, иначе asyncio ругается "exception was never retrieved"
+            receiver.exception()
+        receiver.cancel()
+
+
+# Главная рендерится один раз на версию шаблона, стилей и набор gif и сразу
+# сжимается; повторный визит с If-None-Match получает 304 без тела.
+PAGE_GZIP_LEVEL = 9
+PAGE_RESPONSES = REGISTRY.counter("panel_page_responses_total", "GET / responses by cache result")
+
+
+@dataclass(frozen=True)
+class CachedPage:
+    key: Tuple[Any, ...]
+    digest: str
+    bodies: Dict[str, bytes]            # content-coding → тело
+
+    def etag(self, encoding: str) -> str:
+        # Разные байты — разные сильные ETag
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+
+_page: Optional[CachedPage] = None
+
+
+def render_index(snap: Snapshot) -> CachedPage:
+    global _page
+    # Строк в странице нет (таблица приходит из /api/gifts) — перезапись
+    # файлов парсеров страницу не меняет
+    key = (tuple(snap.gif_files), file_sig(BASE_DIR / "templates" / "index.html"), static_hash("styles.css"))
+    page = _page
+    if page is not None and page.key == key:
+        return page
+    with RENDER_SECONDS.time(route="/"):
+        html = templates.get_template("index.html").render(gif_files=json.dumps(snap.gif_files)).encode("utf-8")
+        bodies = {"identity": html, "gzip": gzip.compress(html, PAGE_GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            bodies["br"] = brotli.compress(html)
+    page = _page = CachedPage(key=key, digest=hashlib.sha256(html).hexdigest()[:20], bodies=bodies)
+    return page
+
+
+def _pick_encoding(accept: str, available: Iterable[str]) -> str:
+    """br > gzip > identity из тех, что клиент принимает (q=0 — отказ)."""
+    accepted = set()
+    for part in accept.split(","):
+        name, *params = part.split(";")
+        q = 1.0
+        for param in params:
+            k, _, v = param.strip().partition("=")
+            if k == "q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(name.strip().lower())
+    for encoding in ("br", "gzip"):
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+
+def _not_modified(if_none_match: Optional[str], page: CachedPage) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        if tag.split("-", 1)[0] == page.digest:
+            return True
+    return False
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
-    data = load_data()
-    gifs_dir = BASE_DIR / "static" / "gifs"
-    gif_files = []
-    if gifs_dir.exists():
-        gif_files = [f"/static/gifs/{p.name}" for p in gifs_dir.iterdir() if p.suffix.lower() == ".gif"]
-    template = templates.get_template("index.html")
-    return template.render(
-        request=request,
-        gifts=data,
-        gif_files=json.dumps(gif_files),
+    snap = await asyncio.to_thread(get_snapshot)
+    page = render_index(snap)
+    encoding = _pick_encoding(request.headers.get("accept-encoding", ""), page.bodies)
+    headers = {"ETag": page.etag(encoding), "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _not_modified(request.headers.get("if-none-match"), page):
+        PAGE_RESPONSES.inc(result="not_modified")
+        return Response(status_code=304, headers=headers)
+    PAGE_RESPONSES.inc(result=encoding)
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(page.bodies[encoding], media_type="text/html; charset=utf-8", headers=headers)
+
+
+API_PAGE_LIMIT = 100
+API_PAGE_LIMIT_MAX = 500
+
+
+def _encode_cursor(sort: str, desc: bool, mark: Mark) -> str:
+    raw = json.dumps([sort, desc, *mark], ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str, sort: str, desc: bool) -> Optional[Mark]:
+    """Метка из курсора; None — курсор битый или от другой сортировки."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        c_sort, c_desc, value, gift, model = json.loads(raw)
+    except (TypeError, ValueError):
+        return None
+    if c_sort != sort or c_desc != desc or not isinstance(gift, str) or not isinstance(model, str):
+        return None
+    if sort == "name":
+        # (gift, model) после JSON — список
+        if not (isinstance(value, list) and len(value) == 2 and all(isinstance(v, str) for v in value)):
+            return None
+        value = tuple(value)
+    elif value is not None and (
+        isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value)
+    ):
+        return None
+    return value, gift, model
+
+
+@app.get("/api/gifts")
+async def api_gifts(
+    sort: str = "delta",
+    order: str = "desc",
+    q: str = "",
+    gift: str = "",
+    model: str = "",
+    rate: Optional[float] = None,
+    currency: str = "ton",
+    min_delta: Optional[float] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    limit: int = API_PAGE_LIMIT,
+    cursor: Optional[str] = None,
+):
+    """
+    Страница склеенных строк из индекса текущего снапшота.
+    rate — курс 1 TON в звёздах: нужен для min_delta и цен в звёздах.
+    cursor — из next_cursor прошлого ответа: метка последней просмотренной
+    строки, а не номер позиции, поэтому переживает перезапись TG вотчером.
+    Битый курсор или курсор другой сортировки → 409.
+    """
+    if sort not in SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {sorted(SORT_KEYS)}")
+    if (min_delta is not None or currency == "stars") and not rate:
+        raise HTTPException(status_code=400, detail="rate is required for min_delta and currency=stars")
+
+    desc = order == "desc"
+    mark = None
+    if cursor:
+        mark = _decode_cursor(cursor, sort, desc)
+        if mark is None:
+            raise HTTPException(status_code=409, detail="invalid cursor, restart from the first page")
+
+    snap = await asyncio.to_thread(get_snapshot)
+    start = snap.index.seek(sort, desc, mark) if mark is not None else 0
+
+    # Фильтры приходят в валюте отображения, индекс хранит цены Thermos в TON
+    scale = rate if currency == "stars" else 1.0
+    price_range = (
+        min_price / scale if min_price is not None else None,
+        max_price / scale if max_price is not None else None,
     )
+    min_ratio = rate * (1 + min_delta / 100) if min_delta is not None else None
 
+    with RENDER_SECONDS.time(route="/api/gifts"):
+        rows, next_pos = snap.index.query(
+            sort=sort,
+            desc=desc,
+            start=start,
+            limit=max(1, min(limit, API_PAGE_LIMIT_MAX)),
+            q=q,
+            gift=gift,
+            model=model,
+            min_ratio=min_ratio,
+            price_range=price_range,
+        )
+        return JSONResponse({
+            "snapshot": snap.tag,
+            "total": len(snap.rows),
+            "items": rows,
+            "next_cursor": (
+                _encode_cursor(sort, desc, snap.index.mark(sort, snap.index.orders[(sort, desc)][next_pos - 1]))
+                if next_pos is not None else None
+            ),
+        })
 
 
-@app.post("/update")
-async def update(request: Request):
+ANALYTICS_K_DEFAULT = 50
+ANALYTICS_K_MAX = 1000
+
+
+@app.get("/api/analytics")
+async def api_analytics(
+    rate: float,
+    by: str = "profit_pct",
+    k: int = ANALYTICS_K_DEFAULT,
+    direction: str = "thermos_to_tg",
+    buy_fee: Optional[float] = None,
+    sell_fee: Optional[float] = None,
+    min_spread_pct: Optional[float] = None,
+    min_profit: Optional[float] = None,
+    min_profit_pct: Optional[float] = None,
+    min_score: Optional[float] = None,
+):
+    """
+    Лучшие по by строки снапшота после комиссий (см. analytics.py).
+    rate — курс 1 TON в звёздах; цены, spread и profit — в TON.
+    min_* — пороги; fee — доли (0.05 = 5%), по умолчанию analytics.FEES.
+    """
+    if analytics is None:
+        raise HTTPException(status_code=503, detail="numpy is not installed")
+    if not (math.isfinite(rate) and rate > 0):
+        raise HTTPException(status_code=400, detail="rate must be positive")
+    for name, fee in (("buy_fee", buy_fee), ("sell_fee", sell_fee)):
+        # Комиссия — доля: sell_fee ≥ 1 съедает всю выручку, отрицательная — бессмыслица; NaN не пройдёт сравнение
+        if fee is not None and not 0 <= fee < 1:
+            raise HTTPException(status_code=400, detail=f"{name} must be in [0, 1)")
+    if by not in analytics.METRICS:
+        raise HTTPException(status_code=400, detail=f"by must be one of {list(analytics.METRICS)}")
+    if direction not in analytics.DIRECTIONS:
+        raise HTTPException(status_code=400, detail=f"direction must be one of {sorted(analytics.DIRECTIONS)}")
+
+    snap = await asyncio.to_thread(get_snapshot)
+    thresholds = {
+        name: value
+        for name, value in (
+            ("spread_pct", min_spread_pct),
+            ("profit", min_profit),
+            ("profit_pct", min_profit_pct),
+            ("score", min_score),
+        )
+        if value is not None
+    }
+    with RENDER_SECONDS.time(route="/api/analytics"):
+        metrics = analytics.compute(snap.table, rate, direction, buy_fee, sell_fee)
+        idx = analytics.select(metrics, by, max(1, min(k, ANALYTICS_K_MAX)), thresholds)
+        items = []
+        for i in idx.tolist():
+            item = dict(snap.rows[i])
+            for name in analytics.METRICS:
+                value = float(metrics[name][i])
+                # JSON не знает NaN/inf — такие значения отдаём как null
+                item[name] = round(value, 4) if math.isfinite(value) else None
+            items.append(item)
+        return JSONResponse({
+            "snapshot": snap.tag,
+            "direction": direction,
+            "by": by,
+            "summary": analytics.summarize(snap.table, metrics),
+            "items": items,
+        })
+
+
+@app.get("/metrics")
+async def metrics():
+    """Счётчики и гистограммы панели и парсеров (в режиме inprocess) для Prometheus."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/runs")
+async def run_summaries():
+    """Сводки последних прогонов парсеров (tg_run_metrics.json, thermos_run_metrics.json)."""
+    out: Dict[str, Any] = {}
+    for source, name in RUN_SUMMARIES.items():
+        try:
+            with open(PARSERS_DIR / name, "r", encoding="utf-8") as f:
+                out[source] = json.load(f)
+        except (OSError, ValueError):
+            out[source] = None
+    return JSONResponse(out)
+
+
+
+# ─── ФОНОВОЕ ОБНОВЛЕНИЕ ──────────────────────────────────────────────────────
+# Парсеры печатают строки прогресса с этим префиксом (см. report_progress).
+PROGRESS_PREFIX = "@@progress "
+JOBS_KEEP = 10
+
+
+@dataclass
+class UpdateJob:
+    id: str
+    started: float
+    status: str = "running"             # running | ok | partial | error
+    sources: List[str] = field(default_factory=list)
+    gifts: Optional[List[str]] = None   # None — весь рынок
+    finished: Optional[float] = None
+    detail: Optional[str] = None
+    progress: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    subscribers: List[asyncio.Queue] = field(default_factory=list, repr=False)
+    written: float = field(default=0.0, repr=False)     # monotonic последней записи файла
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "sources": self.sources,
+            "gifts": self.gifts,
+            "started": self.started,
+            "finished": self.finished,
+            "detail": self.detail,
+            "progress": self.progress,
+        }
+
+    def publish(self, force: bool = True) -> None:
+        """force=False — событие прогресса: файл пишется не чаще JOB_STATE_WRITE_EVERY."""
+        state = self.to_dict()
+        for q in self.subscribers:
+            q.put_nowait(state)
+        now = time.monotonic()
+        if not force and self.status == "running" and now - self.written < JOB_STATE_WRITE_EVERY:
+            return
+        # Для остальных воркеров: /update/{id} и SSE читают этот файл
+        self.written = now
+        write_json(JOB_STATE_FILE, state)
+
+
+_jobs: Dict[str, UpdateJob] = {}
+_current_job: Optional[UpdateJob] = None
+# /update выполняет тот воркер, кто взял _update_lock; наблюдение TG ведёт
+# владелец _watch_lock (и отдаёт его, пока TG-обход идёт в другом воркере)
+_update_lock = FileLock(UPDATE_LOCK_FILE)
+_watch_lock = FileLock(WATCH_LOCK_FILE)
+REMOTE_JOB_POLL = 0.5               # сек: SSE задачи из другого воркера опрашивает файл
+LOCK_POLL_ASYNC = 0.2
+WATCH_HANDOFF_TIMEOUT = 3 * SNAPSHOT_POLL_EVERY
+
+
+def _remote_job_state() -> Optional[Dict[str, Any]]:
+    """Состояние /update другого воркера; если тот умер посреди задачи — error."""
+    state = read_json(JOB_STATE_FILE)
+    if state is None or state.get("status") != "running" or _current_job is not None:
+        return state
+    if _update_lock.acquire(blocking=False):
+        _update_lock.release()
+        state.update(status="error", detail="worker running the update exited")
+    return state
+
+
+_watch_rebuilds: set = set()           # задачи пересборки держим, пока не закончатся
+
+
+def _refresh_watched(gifts: List[str]) -> None:
+    if _snapshot is not None and _snapshot.version == (file_sig(THERMOS_FILE), file_sig(TG_FILE)):
+        return          # poll_snapshot успел пересобрать
+    get_snapshot(True, gifts)
+
+
+async def _rebuild_watched(gifts: List[str]) -> None:
     try:
-        async def run_parser(path: Path) -> None:
-            proc = await asyncio.create_subprocess_exec(str(path), cwd=PARSERS_DIR)
-            await proc.wait()
-            if proc.returncode:
-                raise RuntimeError(f"{path.name} exited with code {proc.returncode}")
-
-        # Запускаем парсеры последовательно
-        await run_parser(TG_PARSER)
-        await run_parser(THERMOS_PARSER)
-
-        # Переносим результаты в корень панели
-        src = PARSERS_DIR / "tg_gifts_resale.json"
-        if src.exists():
-            shutil.move(src, TG_FILE)
+        await asyncio.to_thread(_refresh_watched, gifts)
+    except Exception as exc:
+        print(f"watch rebuild: {exc!r}", flush=True)
+
+
+def _watch_flushed(event: Dict[str, Any]) -> None:
+    """Наблюдение переписало TG_FILE: склейку пересобираем только по изменённым подаркам."""
+    gifts = event.get("gifts")
+    if not gifts:
+        return
+    task = asyncio.get_running_loop().create_task(_rebuild_watched(gifts))
+    _watch_rebuilds.add(task)
+    task.add_done_callback(_watch_rebuilds.discard)
+
+
+async def _claim_watch() -> None:
+    """
+    TG-обход в этом воркере: забираем наблюдение у владельца (он отпускает
+    _watch_lock в poll_snapshot) — сессия одна, два клиента на ней нельзя.
+    После обхода наблюдение продолжит этот воркер.
+    """
+    if _watch_lock.held:
+        return
+    deadline = time.monotonic() + WATCH_HANDOFF_TIMEOUT
+    while not _watch_lock.acquire(blocking=False):
+        if time.monotonic() > deadline:
+            raise RuntimeError("tg watch is still running in another worker")
+        await asyncio.sleep(LOCK_POLL_ASYNC)
+    engine.start_watch(TG_FILE, _watch_flushed)
+
+
+engine = ParserEngine(PARSERS_DIR)
+
+
+def _apply_progress(job: UpdateJob, event: Dict[str, Any]) -> None:
+    event = dict(event)
+    source = event.pop("source", "?")
+    state = job.progress.setdefault(source, {})
+    new_stage = event.get("stage", state.get("stage")) != state.get("stage")
+    state.update(event)
+    job.publish(force=new_stage)
+
+
+def _handle_progress(job: UpdateJob, line: str) -> None:
+    try:
+        event = json.loads(line[len(PROGRESS_PREFIX):])
+    except ValueError:
+        return
+    _apply_progress(job, event)
 
-        src = PARSERS_DIR / "thermos_gifts.json"
+
+async def run_parser(job: UpdateJob, path: Path, args: List[str]) -> None:
+    env = dict(os.environ, PYTHONIOENCODING="utf-8")
+    proc = await asyncio.create_subprocess_exec(
+        str(path), *args, cwd=PARSERS_DIR, env=env,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    assert proc.stdout is not None
+    async for raw_line in proc.stdout:
+        line = raw_line.decode("utf-8", errors="replace").rstrip()
+        if line.startswith(PROGRESS_PREFIX):
+            _handle_progress(job, line)
+        else:
+            print(line, flush=True)
+    await proc.wait()
+    if proc.returncode:
+        raise RuntimeError(f"{path.name} exited with code {proc.returncode}")
+
+
+# source → (исполняемый файл, имя выходного файла в PARSERS_DIR, файл панели)
+SOURCES: Dict[str, Tuple[Path, str, Path]] = {
+    "tg": (TG_PARSER, "tg_gifts_resale.json", TG_FILE),
+    "thermos": (THERMOS_PARSER, "thermos_gifts.json", THERMOS_FILE),
+}
+
+
+def publish_file(src: Path, dest: Path) -> None:
+    """Атомарно подменяет dest: читатель видит либо старый, либо новый файл."""
+    try:
+        os.replace(src, dest)
+    except OSError:
+        # другой диск — копируем рядом с dest и подменяем уже там
+        tmp = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+        src.unlink()
+
+
+async def refresh_source(job: UpdateJob, source: str) -> None:
+    """
+    Запускает один парсер и сразу публикует его результат в панель.
+    job.gifts — выборочно: парсер снимает только их, остальные строки
+    переносит из текущего файла панели (dest).
+    """
+    path, out_name, dest = SOURCES[source]
+    gifts = job.gifts
+    base = dest if gifts else None
+    state = job.progress.setdefault(source, {})
+    state["status"] = "running"
+    t0 = time.perf_counter()
+    try:
+        inprocess = PARSER_MODE == "inprocess" and engine.available(source)
+        if inprocess:
+            state["mode"] = "inprocess"
+            if source == "tg" and TG_WATCH:
+                await _claim_watch()
+            run = engine.run_tg if source == "tg" else engine.run_thermos
+            try:
+                await run(PARSERS_DIR / out_name, lambda event: _apply_progress(job, event), gifts, base)
+            except EngineUnavailable as exc:
+                print(f"{source}: {exc} → exe", flush=True)
+                inprocess = False
+        if not inprocess:
+            state["mode"] = "subprocess"
+            args = [arg for g in gifts or [] for arg in ("--gift", g)]
+            if base is not None:
+                args += ["--base", str(base)]
+            await run_parser(job, path, args)
+
+        # Переносим результат в корень панели. При выборочном обновлении
+        # снапшот сначала догоняет файлы, чтобы затем сменился только dest.
+        src = PARSERS_DIR / out_name
+        if gifts:
+            await asyncio.to_thread(get_snapshot)
         if src.exists():
-            shutil.move(src, THERMOS_FILE)
+            publish_file(src, dest)
+
+        await asyncio.to_thread(get_snapshot, True, gifts)
+        state["status"] = "ok"
+        REFRESH_SECONDS.observe(time.perf_counter() - t0, source=source, mode=state["mode"])
+    except Exception as exc:
+        state["status"] = "error"
+        state["detail"] = str(exc)
+        raise
+    finally:
+        job.publish()
+
 
+async def run_update(job: UpdateJob) -> None:
+    global _current_job
+    try:
+        # Парсеры независимы: Thermos — один HTTP-запрос, он целиком
+        # перекрывается долгим MTProto-сканом. Ошибка одного не отменяет другой.
+        results = await asyncio.gather(
+            *(refresh_source(job, source) for source in job.sources),
+            return_exceptions=True,
+        )
+        errors = [f"{source}: {res}" for source, res in zip(job.sources, results) if isinstance(res, BaseException)]
+        if not errors:
+            job.status = "ok"
+        else:
+            job.status = "partial" if len(errors) < len(job.sources) else "error"
+            job.detail = "; ".join(errors)
     except Exception as exc:
-        return JSONResponse({"status": "error", "detail": str(exc)}, status_code=500)
-    return JSONResponse({"status": "ok"})
+        job.status = "error"
+        job.detail = str(exc)
+    finally:
+        job.finished = time.time()
+        _current_job = None
+        job.publish()
+        _update_lock.release()
+
+
+@app.get("/api/history")
+async def price_history(gift: str, model: str, hours: float = 24 * 7):
+    """Ряд цен (gift, model) по обоим источникам и цены сутки назад."""
+    now = time.time()
+    series = await asyncio.to_thread(history.series, gift, model, now - hours * 3600)
+    day_ago = {
+        source: await asyncio.to_thread(history.price_at, source, gift, model, now - 24 * 3600)
+        for source in SOURCES
+    }
+    return JSONResponse({
+        "gift": gift,
+        "model": model,
+        "series": [{"source": src, "ts": ts, "price": price} for src, ts, price in series],
+        "price_24h_ago": day_ago,
+    })
+
+
+def _job_state(job_id: str) -> Dict[str, Any]:
+    """Задача этого воркера или текущая/последняя задача другого."""
+    job = _jobs.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    state = _remote_job_state()
+    if state is None or state.get("job_id") != job_id:
+        raise HTTPException(status_code=404, detail="unknown job")
+    return state
+
+
+@app.post("/update")
+async def update(request: Request):
+    """
+    Запускает обновление в фоне или подключается к уже идущему.
+    Тело (необязательно): {"source": "all" | "tg" | "thermos", "gifts": [название, ...]}
+    — обновить только эти источник и подарки.
+    """
+    global _current_job
+    body: Dict[str, Any] = {}
+    if await request.body():
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="body must be JSON")
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail="body must be a JSON object")
+    source = body.get("source") or "all"
+    if source != "all" and source not in SOURCES:
+        raise HTTPException(status_code=400, detail=f"source must be 'all' or one of {sorted(SOURCES)}")
+    gifts = body.get("gifts") or None
+    if gifts is not None and (not isinstance(gifts, list) or not all(isinstance(g, str) and g for g in gifts)):
+        raise HTTPException(status_code=400, detail="gifts must be a list of gift names")
+
+    job = _current_job
+    if job is not None:
+        return JSONResponse({**job.to_dict(), "attached": True})
+    if not _update_lock.acquire(blocking=False):
+        state = _remote_job_state()
+        if state is None or state.get("status") != "running":
+            raise HTTPException(status_code=409, detail="update is starting in another worker, retry")
+        return JSONResponse({**state, "attached": True})
+
+    job = UpdateJob(
+        id=uuid.uuid4().hex,
+        started=time.time(),
+        sources=list(SOURCES) if source == "all" else [source],
+        gifts=list(dict.fromkeys(gifts)) if gifts else None,
+    )
+    _current_job = job
+    _jobs[job.id] = job
+    while len(_jobs) > JOBS_KEEP:
+        _jobs.pop(next(iter(_jobs)))
+    job.publish()
+    asyncio.create_task(run_update(job))
+    return JSONResponse({**job.to_dict(), "attached": False}, status_code=202)
+
+
+@app.get("/update/{job_id}")
+async def update_status(job_id: str):
+    return JSONResponse(_job_state(job_id))
+
+
+@app.get("/update/{job_id}/events")
+async def update_events(job_id: str):
+    """SSE-поток состояния задачи; закрывается, когда задача завершена."""
+    state = _job_state(job_id)
+    job = _jobs.get(job_id)
+
+    async def remote_stream():
+        # Задача идёт в другом воркере — следим за её файлом состояния
+        nonlocal state
+        while True:
+            yield f"data: {json.dumps(state, ensure_ascii=False)}\n\n"
+            if state["status"] != "running":
+                break
+            last = state
+            while state == last:
+                await asyncio.sleep(REMOTE_JOB_POLL)
+                state = _remote_job_state() or last
+                if state.get("job_id") != job_id:
+                    state = {**last, "status": "error", "detail": "job state was replaced"}
+
+    async def stream():
+        q: asyncio.Queue = asyncio.Queue()
+        job.subscribers.append(q)
+        try:
+            state = job.to_dict()
+            while True:
+                yield f"data: {json.dumps(state, ensure_ascii=False)}\n\n"
+                if state["status"] != "running":
+                    break
+                state = await q.get()
+        finally:
+            job.subscribers.remove(q)
+
+    return StreamingResponse(
+        stream() if job is not None else remote_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def poll_snapshot() -> None:
+    """Файл снапшота поменялся (наблюдение, exe, ручная правка) → пересборка и дифф в /ws/changes."""
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL_EVERY)
+        try:
+            await asyncio.to_thread(get_snapshot)
+        except Exception as exc:
+            print(f"poll_snapshot: {exc!r}", flush=True)
+        if TG_WATCH:
+            await balance_watch()
+
+
+async def balance_watch() -> None:
+    """
+    Наблюдение TG — ровно в одном воркере: отдаём его, пока /update идёт в
+    другом (см. _claim_watch), и подхватываем, если владельца нет.
+    """
+    if _current_job is not None or not (PARSER_MODE == "inprocess" and engine.available("tg")):
+        return
+    state = _remote_job_state()
+    busy = state is not None and state.get("status") == "running"
+    if _watch_lock.held and busy:
+        await engine.stop_watch()
+        _watch_lock.release()
+    elif not _watch_lock.held and not busy and _watch_lock.acquire(blocking=False):
+        engine.start_watch(TG_FILE, _watch_flushed)
+
+
+_background: List[asyncio.Task] = []
+
+
+@app.on_event("startup")
+async def start_background():
+    _background.append(asyncio.create_task(poll_snapshot()))
+    if TG_WATCH:
+        await balance_watch()
+
+
+@app.on_event("shutdown")
+async def close_engine():
+    for task in _background:
+        task.cancel()
+    await engine.close()
+    _watch_lock.release()
 
 
 if __name__ == "__main__":
     import sys, uvicorn
     is_exe = getattr(sys, "frozen", False)
-    uvicorn.run(
-        app,                    # ← передаём прямо объект
-        host="127.0.0.1",
-        port=8000,
-        reload=False
-    )
+    if WORKERS > 1 and not is_exe:
+        # Несколько воркеров uvicorn поднимает только по строке импорта
+        uvicorn.run("main:app", host=HOST, port=PORT, workers=WORKERS, reload=False)
+    else:
+        # exe распаковывается в свой каталог на процесс — общие файлы не
+        # совпали бы, поэтому в exe всегда один воркер
+        uvicorn.run(
+            app,                    # ← передаём прямо объект
+            host=HOST,
+            port=PORT,
+            reload=False
+        )
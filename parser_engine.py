@@ -0,0 +1,172 @@
+# parser_engine.py
+"""
+Парсеры внутри процесса панели.
+
+Вместо запуска exe на каждое обновление модули парсеров импортируются один
+раз, а авторизованный Client держится открытым между обновлениями: без
+распаковки exe, старта интерпретатора, импорта pyrogram и MTProto-рукопожатия.
+Если что-то из этого недоступно, панель откатывается на подпроцессы.
+"""
+import asyncio
+import importlib
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Optional
+
+ProgressHook = Callable[[Dict[str, Any]], None]
+
+
+class EngineUnavailable(RuntimeError):
+    """Парсер нельзя запустить в процессе — панель запускает exe."""
+
+
+TG_MODULE = "parce_tg_market_kurigram"
+THERMOS_MODULE = "parce_thermos_gifts"
+WATCH_RESTART_DELAY = 30.0          # сек до перезапуска упавшего наблюдения
+
+
+class ParserEngine:
+    def __init__(self, parsers_dir: Path):
+        self.parsers_dir = parsers_dir
+        self._modules: Dict[str, Optional[ModuleType]] = {}
+        self._client = None
+        self._client_lock = asyncio.Lock()
+        self._watch: Optional[asyncio.Task] = None
+        self._watch_path: Optional[Path] = None
+        self._watch_hook: Optional[ProgressHook] = None
+
+    def _module(self, name: str) -> Optional[ModuleType]:
+        """Импорт парсера; None — если зависимостей нет (тогда только exe)."""
+        if name not in self._modules:
+            if str(self.parsers_dir) not in sys.path:
+                sys.path.insert(0, str(self.parsers_dir))
+            try:
+                self._modules[name] = importlib.import_module(name)
+            except Exception as exc:
+                print(f"parser_engine: {name} недоступен в процессе ({exc!r}) → exe", flush=True)
+                self._modules[name] = None
+        return self._modules[name]
+
+    def available(self, source: str) -> bool:
+        if source == "thermos":
+            return self._module(THERMOS_MODULE) is not None
+        tg = self._module(TG_MODULE)
+        if tg is None:
+            return False
+        # Шардированный обход — это процессы на каждую сессию; его ведёт exe.
+        # Без файла сессии нужен интерактивный вход — тоже только в консоли exe.
+        sessions = tg.discover_sessions()
+        return len(sessions) == 1 and Path(sessions[0] + ".session").exists()
+
+    async def _tg_client(self):
+        async with self._client_lock:
+            if self._client is not None and self._client.is_connected:
+                return self._client
+            tg = self._module(TG_MODULE)
+            client = tg.Client(tg.discover_sessions()[0], api_id=tg.API_ID, api_hash=tg.API_HASH)
+            try:
+                authorized = await client.connect()
+            except Exception as exc:
+                raise EngineUnavailable(f"tg connect failed: {exc!r}") from exc
+            if not authorized:
+                await client.disconnect()
+                raise EngineUnavailable("tg session is not authorized")
+            await client.initialize()
+            self._client = client
+            return client
+
+    async def run_tg(self, out_path: Path, progress: ProgressHook,
+                     gifts: Optional[List[str]] = None, base_path: Optional[Path] = None) -> int:
+        tg = self._module(TG_MODULE)
+        # Полный обход и наблюдение не делят клиент: наблюдение ждёт конца обхода
+        watch_path, watch_hook = self._watch_path, self._watch_hook
+        await self.stop_watch()
+        try:
+            client = await self._tg_client()
+            # Чекпоинт и публикация файла идут в потоке — прогресс возвращаем в цикл событий
+            loop = asyncio.get_running_loop()
+            tg.PROGRESS_HOOK = lambda event: loop.call_soon_threadsafe(progress, event)
+            try:
+                return await tg.parse_market(
+                    client, str(out_path), gifts, str(base_path) if base_path else None,
+                )
+            except Exception:
+                # Клиент мог остаться в плохом состоянии — переподключимся в следующий раз
+                await self._drop_client()
+                raise
+            finally:
+                tg.PROGRESS_HOOK = None
+        finally:
+            if watch_path is not None:
+                self.start_watch(watch_path, watch_hook)
+
+    def start_watch(self, out_path: Path, on_flush: Optional[ProgressHook] = None) -> None:
+        """
+        Режим наблюдения TG-парсера фоновой задачей: правит out_path на месте.
+        on_flush(event) — после каждой перезаписи; event["gifts"] — изменённые подарки.
+        """
+        if self._watch is not None and not self._watch.done():
+            return
+        self._watch_path = out_path
+        self._watch_hook = on_flush
+        self._watch = asyncio.get_running_loop().create_task(self._watch_loop(out_path, on_flush))
+
+    async def _watch_loop(self, out_path: Path, on_flush: Optional[ProgressHook]) -> None:
+        tg = self._module(TG_MODULE)
+        while True:
+            try:
+                client = await self._tg_client()
+                # Прочий прогресс наблюдения панели не нужен — только перезаписи
+                # файла; flush идёт в потоке, событие возвращаем в цикл событий
+                loop = asyncio.get_running_loop()
+                tg.PROGRESS_HOOK = (
+                    lambda event: loop.call_soon_threadsafe(on_flush, event)
+                    if on_flush and event.get("stage") == "watch" else None
+                )
+                await tg.watch_market(client, str(out_path))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"parser_engine: наблюдение упало ({exc!r}) → повтор через {WATCH_RESTART_DELAY:.0f}s", flush=True)
+                await self._drop_client()
+                await asyncio.sleep(WATCH_RESTART_DELAY)
+
+    async def stop_watch(self) -> None:
+        task, self._watch, self._watch_path, self._watch_hook = self._watch, None, None, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+    async def run_thermos(self, out_path: Path, progress: ProgressHook,
+                          gifts: Optional[List[str]] = None, base_path: Optional[Path] = None) -> int:
+        thermos = self._module(THERMOS_MODULE)
+        loop = asyncio.get_running_loop()
+        # requests синхронный — работаем в потоке, прогресс возвращаем в цикл событий
+        thermos.PROGRESS_HOOK = lambda event: loop.call_soon_threadsafe(progress, event)
+        try:
+            return await asyncio.to_thread(
+                thermos.run, str(out_path), gifts, str(base_path) if base_path else None,
+            )
+        finally:
+            thermos.PROGRESS_HOOK = None
+
+    async def _drop_client(self) -> None:
+        client, self._client = self._client, None
+        if client is None:
+            return
+        try:
+            if client.is_initialized:
+                await client.terminate()
+            await client.disconnect()
+        except Exception:
+            pass
+
+    async def close(self) -> None:
+        await self.stop_watch()
+        async with self._client_lock:
+            await self._drop_client()
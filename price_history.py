@@ -0,0 +1,179 @@
+# price_history.py
+"""
+История цен в SQLite.
+
+Каждый новый файл парсера загружается одним снапшотом:
+  snapshots(id, source, ts, file_sig, row_count)
+  prices(snapshot_id, source, gift, model, rarity, price, ts)
+Склейка для панели и «цена N часов назад» — индексные запросы,
+а не полный разбор JSON.
+"""
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Хранение: снапшоты старше RETENTION_DAYS удаляются, остальные прореживаются
+# по THIN_TIERS — (возраст, шаг), сек: старше «возраста» остаётся последний
+# снапшот источника на каждый «шаг». Действует самый грубый подходящий ярус.
+# Частые снапшоты режима наблюдения живут полной частотой только первые минуты.
+# Последний снапшот источника не трогаем.
+RETENTION_DAYS = 90
+DAILY_AFTER_DAYS = 7
+THIN_TIERS = (
+    (10 * 60, 5 * 60),
+    (6 * 3600, 3600),
+    (DAILY_AFTER_DAYS * 86400, 86400),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id        INTEGER PRIMARY KEY,
+    source    TEXT    NOT NULL,
+    ts        REAL    NOT NULL,
+    file_sig  TEXT,
+    row_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_source_ts ON snapshots(source, ts);
+
+CREATE TABLE IF NOT EXISTS prices (
+    snapshot_id INTEGER NOT NULL,
+    source      TEXT    NOT NULL,
+    gift        TEXT    NOT NULL,
+    model       TEXT    NOT NULL,
+    rarity      REAL,
+    price       REAL,
+    ts          REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prices_gift_model_ts ON prices(gift, model, ts);
+CREATE INDEX IF NOT EXISTS prices_snapshot ON prices(snapshot_id, gift, model);
+"""
+
+
+class PriceHistory:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def latest(self, source: str) -> Optional[Tuple[int, Optional[str]]]:
+        """-> (snapshot_id, file_sig) последнего снапшота источника."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, file_sig FROM snapshots WHERE source = ? ORDER BY ts DESC, id DESC LIMIT 1",
+                (source,),
+            ).fetchone()
+
+    def ingest(self, source: str, rows: Iterable[Any], *, ts: float, sig: str) -> Optional[int]:
+        """
+        Загружает файл парсера одним снапшотом (строки — GiftRow). Тот же файл
+        (sig) второй раз не грузится — возвращает None. Дубли (gift, model)
+        схлопываются в последний.
+        """
+        last = self.latest(source)
+        if last is not None and last[1] == sig:
+            return None
+        dedup: Dict[Tuple[str, str], Any] = {}
+        for r in rows:
+            dedup[(r.gift, r.model)] = r
+        with self._lock, self._db:
+            cur = self._db.execute(
+                "INSERT INTO snapshots(source, ts, file_sig, row_count) VALUES (?, ?, ?, ?)",
+                (source, ts, sig, len(dedup)),
+            )
+            snapshot_id = cur.lastrowid
+            self._db.executemany(
+                "INSERT INTO prices(snapshot_id, source, gift, model, rarity, price, ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (snapshot_id, source, gift, model, r.rarity, r.price, ts)
+                    for (gift, model), r in dedup.items()
+                ),
+            )
+        return snapshot_id
+
+    def joined(
+        self, thermos_source: str, tg_source: str, gifts: Optional[Iterable[str]] = None,
+    ) -> List[Tuple[str, str, Optional[float], Optional[float], Optional[str]]]:
+        """
+        Пересечение последних снапшотов двух источников:
+        [(gift, model, thermos_price, tg_price, tg_rarity)], по (gift, model).
+        gifts — только эти подарки (индекс prices_snapshot по (snapshot_id, gift)).
+        """
+        t = self.latest(thermos_source)
+        g = self.latest(tg_source)
+        if t is None or g is None:
+            return []
+        params: List[Any] = [g[0], t[0]]
+        only = ""
+        if gifts is not None:
+            gifts = list(gifts)
+            only = f"AND t.gift IN ({', '.join('?' * len(gifts))})" if gifts else "AND 0"
+            params += gifts
+        with self._lock:
+            return self._db.execute(
+                f"""
+                SELECT t.gift, t.model, t.price, g.price, g.rarity
+                FROM prices t
+                JOIN prices g ON g.snapshot_id = ? AND g.gift = t.gift AND g.model = t.model
+                WHERE t.snapshot_id = ? {only}
+                ORDER BY t.gift, t.model
+                """,
+                params,
+            ).fetchall()
+
+    def price_at(self, source: str, gift: str, model: str, ts: float) -> Optional[float]:
+        """Последняя известная цена (gift, model) на момент ts."""
+        with self._lock:
+            row = self._db.execute(
+                """
+                SELECT price FROM prices
+                WHERE gift = ? AND model = ? AND ts <= ? AND source = ?
+                ORDER BY ts DESC LIMIT 1
+                """,
+                (gift, model, ts, source),
+            ).fetchone()
+        return row[0] if row else None
+
+    def series(self, gift: str, model: str, since: float = 0.0) -> List[Tuple[str, float, Optional[float]]]:
+        """-> [(source, ts, price)] по возрастанию ts."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT source, ts, price FROM prices WHERE gift = ? AND model = ? AND ts >= ? ORDER BY ts",
+                (gift, model, since),
+            ).fetchall()
+
+    def compact(
+        self,
+        retention_days: float = RETENTION_DAYS,
+        tiers: Tuple[Tuple[float, float], ...] = THIN_TIERS,
+    ) -> int:
+        """Чистка старых снапшотов; возвращает число удалённых."""
+        now = time.time()
+        drop_before = now - retention_days * 86400
+        with self._lock, self._db:
+            snaps = self._db.execute("SELECT id, source, ts FROM snapshots ORDER BY id").fetchall()
+            latest = {source: snap_id for snap_id, source, _ in snaps}
+            kept: Dict[Tuple[str, float, int], int] = {}
+            ids: List[int] = []
+            for snap_id, source, ts in snaps:
+                if latest[source] == snap_id:
+                    continue
+                if ts < drop_before:
+                    ids.append(snap_id)
+                    continue
+                step = None
+                for min_age, tier_step in sorted(tiers):
+                    if now - ts > min_age:
+                        step = tier_step
+                if step is None:
+                    continue
+                bucket = (source, step, int(ts // step))
+                # по возрастанию id: в корзине остаётся последний
+                if bucket in kept:
+                    ids.append(kept[bucket])
+                kept[bucket] = snap_id
+            self._db.executemany("DELETE FROM prices WHERE snapshot_id = ?", ((i,) for i in ids))
+            self._db.executemany("DELETE FROM snapshots WHERE id = ?", ((i,) for i in ids))
+        return len(ids)
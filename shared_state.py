@@ -0,0 +1,158 @@
+# shared_state.py
+"""
+Общее состояние нескольких воркеров панели.
+
+FileLock — межпроцессная блокировка на файле (fcntl.flock на POSIX,
+msvcrt.locking на Windows): кто взял — собирает снапшот или ведёт /update.
+SharedSnapshot — склеенные строки одним файлом: строка-заголовок JSON
+(generation, version, ...) и JSON-массив строк (через orjson, если он
+установлен). Пишет тот, кто собрал снапшот (temp + rename), остальные
+читают через mmap, не трогая файлы парсеров и историю.
+"""
+import json
+import mmap
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+LOCK_POLL = 0.05            # сек между попытками msvcrt.locking (он не умеет ждать сам)
+REPLACE_RETRIES = 20        # Windows не даёт заменить файл, пока его читают
+
+
+class FileLock:
+    """Исключительная блокировка файла; держится, пока открыт дескриптор."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.name == "nt":
+                while True:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise
+                        time.sleep(LOCK_POLL)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            if os.name == "nt":
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def replace_file(tmp: str, path: Path) -> None:
+    for attempt in range(REPLACE_RETRIES):
+        try:
+            os.replace(tmp, path)
+            return
+        except PermissionError:
+            if attempt == REPLACE_RETRIES - 1:
+                raise
+            time.sleep(LOCK_POLL)
+
+
+def write_json(path: Path, data: Any) -> None:
+    """Небольшой JSON атомарно (temp + rename)."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    replace_file(tmp, path)
+
+
+def read_json(path: Path) -> Optional[Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+class SharedSnapshot:
+    def __init__(self, path: Path):
+        self.path = path
+
+    def publish(self, header: Dict[str, Any], rows: List[Dict[str, Any]]) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(_dumps(header))
+            f.write(b"\n")
+            f.write(_dumps(rows))
+        replace_file(tmp, self.path)
+
+    def _read(self, with_rows: bool) -> Optional[Tuple[Dict[str, Any], Optional[List[Dict[str, Any]]]]]:
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = mm.find(b"\n")
+                if end < 0:
+                    return None
+                header = _loads(mm[:end])
+                rows = _loads(mm[end + 1:]) if with_rows else None
+        return header, rows
+
+    def header(self) -> Optional[Dict[str, Any]]:
+        """Только заголовок — тело не читается."""
+        got = self._read(False)
+        return got[0] if got else None
+
+    def load(self) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        return self._read(True)